@@ -1,10 +1,10 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_jsonrpc import JSONRPC
+from api.database import Database
 
 app = Flask(__name__)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = Database(app)
 
 
 
@@ -0,0 +1,140 @@
+"""ASGI entry point, e.g. `uvicorn api.asgi:application`
+
+The event loop owns the sockets: request bodies are received into a spooled
+temp file and responses are sent chunk by chunk, so a slow client only holds a
+coroutine. The Flask app itself, with its SQLAlchemy and storage calls, runs
+on a bounded thread pool, and so does every read of the response iterator and
+every write of the spooled body.
+"""
+import sys
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import FileWrapper
+from api import app, views, tasks, security
+
+_done = object()
+
+
+class WSGIAdapter(object):
+
+    def __init__(self, wsgi_app, max_workers, spool_size, block_size, max_body_size=None):
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asgi')
+        self.spool_size = spool_size
+        self.block_size = block_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f'unsupported scope {scope["type"]}')
+        loop = asyncio.get_event_loop()
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            size = await self.receive_body(loop, receive, body)
+            if size is None:
+                return
+            if self.max_body_size is not None and size > self.max_body_size:
+                await send({'type': 'http.response.start', 'status': 413, 'headers': []})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            await self.respond(loop, scope, body, size, send)
+        finally:
+            await loop.run_in_executor(self.executor, body.close)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                tasks.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                # after the last request, so the download counts it recorded are flushed too
+                tasks.stop()
+                security.pool.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def receive_body(self, loop, receive, body):
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if chunk and (self.max_body_size is None or size <= self.max_body_size):
+                await loop.run_in_executor(self.executor, body.write, chunk)
+            if not message.get('more_body', False):
+                body.seek(0)
+                return size
+
+    async def respond(self, loop, scope, body, size, send):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return lambda data: None
+
+        iterable = await loop.run_in_executor(self.executor, self.wsgi_app,
+                                              self.environ(scope, body, size), start_response)
+        try:
+            iterator = iter(iterable)
+            first = await loop.run_in_executor(self.executor, next, iterator, _done)
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            chunk = first
+            while chunk is not _done:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, iterator, _done)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+    def file_wrapper(self, file, buffer_size=8192):
+        # bigger blocks mean fewer hops between the loop and the pool
+        return FileWrapper(file, max(buffer_size, self.block_size))
+
+    def environ(self, scope, body, size):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(size),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': self.file_wrapper,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+
+application = WSGIAdapter(app, max_workers=app.config['ASGI_WORKER_THREADS'],
+                          spool_size=app.config['ASGI_SPOOL_SIZE'], block_size=app.config['ASGI_BLOCK_SIZE'],
+                          max_body_size=app.config['MAX_CONTENT_LENGTH'])
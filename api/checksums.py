@@ -0,0 +1,28 @@
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+def has_crc32c():
+    """CRC-32C needs the crc32c package, a pure python one would hold the GIL for seconds on a big upload"""
+    return _crc32c is not None
+
+
+def crc32c(data):
+    """CRC-32C (Castagnoli) of data"""
+    if _crc32c is None:
+        raise RuntimeError('crc32c checksums need the crc32c package')
+    return _crc32c.crc32c(data)
+
+
+def matches(data, digest, sha256=None, crc32c_hex=None):
+    """whether data, whose sha256 hex digest is already known, has the checksums the client sent"""
+    if sha256 is not None and sha256.lower() != digest:
+        return False
+    if crc32c_hex is not None:
+        try:
+            return int(crc32c_hex, 16) == crc32c(data)
+        except ValueError:
+            return False
+    return True
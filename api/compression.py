@@ -0,0 +1,77 @@
+import gzip
+import math
+import shutil
+import mimetypes
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1024*1024
+PROBE_SIZE = 64*1024
+
+# formats that are compressed already, a second pass only burns cpu
+COMPRESSED_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'video/', 'audio/',
+                    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+                    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+                    'application/zstd', 'application/pdf', 'font/woff')
+TEXT_TYPES = ('text/', 'application/json', 'application/xml', 'application/javascript',
+              'application/x-ndjson', 'application/sql', 'image/svg+xml', 'image/bmp')
+
+
+class GzipReader(gzip.GzipFile):
+    """closes the stored stream along with itself"""
+
+    def close(self):
+        stream = self.fileobj
+        try:
+            super().close()
+        finally:
+            if stream is not None:
+                stream.close()
+
+
+def entropy(data):
+    """shannon entropy in bits per byte, 8 means random"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def choose_encoding(filename, path, codec, max_entropy):
+    """encoding to store the file with, or None to keep it verbatim"""
+    if codec is None:
+        return None
+    mimetype, encoding = mimetypes.guess_type(filename or '')
+    if encoding is not None or (mimetype and mimetype.startswith(COMPRESSED_TYPES)):
+        return None
+    if mimetype and mimetype.startswith(TEXT_TYPES):
+        return codec
+    with open(path, "rb") as file:
+        probe = file.read(PROBE_SIZE)
+    return codec if entropy(probe) < max_entropy else None
+
+
+def compress(source, destination, encoding, level):
+    with open(source, "rb") as raw, open(destination, "wb") as compressed:
+        if encoding == 'gzip':
+            with gzip.GzipFile(fileobj=compressed, mode="wb", compresslevel=level, mtime=0) as stream:
+                shutil.copyfileobj(raw, stream, CHUNK_SIZE)
+        elif encoding == 'zstd':
+            zstandard.ZstdCompressor(level=level).copy_stream(raw, compressed, read_size=CHUNK_SIZE)
+        else:
+            raise ValueError(f'unknown encoding {encoding}')
+
+
+def decompressed(stream, encoding):
+    """wraps a stored stream so reads return the original bytes"""
+    if encoding in (None, 'identity'):
+        return stream
+    if encoding == 'gzip':
+        return GzipReader(fileobj=stream, mode="rb")
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_size=CHUNK_SIZE, closefd=True)
+    raise ValueError(f'unknown encoding {encoding}')
@@ -0,0 +1,81 @@
+import atexit
+import threading
+from collections import Counter, defaultdict
+from api import app, db, tasks
+
+FLUSH_CHUNK = 500  # ids per UPDATE, below the SQLite variable limit
+
+
+class DownloadCounter(object):
+    """download counts on their way to File.download_count.
+
+    record() adds one to a per-file count in memory, so a download opens no
+    write transaction. flush() swaps the counts for an empty Counter and adds
+    them with one UPDATE per distinct increment and chunk of ids. The flush
+    task is started by the first download, whatever server runs the app.
+    """
+
+    def __init__(self, task_name):
+        self.task_name = task_name
+        self.pending = Counter()
+        self.flushing = Counter()
+        # held for a dict update, never across the database
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.started = False
+
+    def record(self, file_id):
+        with self.lock:
+            self.pending[file_id] += 1
+        if not self.started:
+            self.started = True
+            tasks.start(self.task_name)
+
+    def unflushed(self, file_id):
+        return self.pending.get(file_id, 0) + self.flushing.get(file_id, 0)
+
+    def clear(self):
+        with self.lock:
+            self.pending = Counter()
+
+    def flush(self):
+        """writes the recorded counts in one transaction, returns how many downloads that was"""
+        with self.flush_lock:
+            with self.lock:
+                counts, self.pending = self.pending, Counter()
+            if not counts:
+                return 0
+            self.flushing = counts
+            by_increment = defaultdict(list)
+            for file_id, count in counts.items():
+                by_increment[count].append(file_id)
+            file = db.metadata.tables['file']
+            try:
+                for count, file_ids in by_increment.items():
+                    added = db.func.coalesce(file.c.download_count, 0) + count
+                    for start in range(0, len(file_ids), FLUSH_CHUNK):
+                        chunk = file_ids[start:start + FLUSH_CHUNK]
+                        db.session.execute(file.update().where(file.c.id.in_(chunk)).values(download_count=added))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # back in line for the next flush
+                with self.lock:
+                    self.flushing = Counter()
+                    self.pending.update(counts)
+                raise
+            self.flushing = Counter()
+            return sum(counts.values())
+
+
+downloads = DownloadCounter('download-counter')
+
+
+@atexit.register
+def flush_at_exit():
+    if downloads.pending:
+        with app.app_context():
+            try:
+                downloads.flush()
+            except Exception:
+                app.logger.exception('download counts were lost at exit')
@@ -0,0 +1,44 @@
+import sqlite3
+from functools import partial
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy with the pool settings of the DB_* config keys and, on SQLite,
+    the SQLITE_* pragmas set on every new connection"""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        in_memory = sa_url.database in (None, '', ':memory:')
+        if sa_url.drivername.startswith('sqlite') and not in_memory:
+            # the default NullPool reopens the file and reruns the pragmas on every checkout
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+        if not in_memory:
+            options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', app.config['DB_POOL_TIMEOUT'])
+            options.setdefault('pool_recycle', app.config['DB_POOL_RECYCLE'])
+        if not sa_url.drivername.startswith('sqlite'):
+            options.setdefault('pool_pre_ping', True)
+        return super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', partial(sqlite_pragmas, self.get_app().config))
+        return engine
+
+
+def sqlite_pragmas(config, connection, record):
+    if not isinstance(connection, sqlite3.Connection):
+        return
+    cursor = connection.cursor()
+    try:
+        # WAL lets readers go on while one upload commits, NORMAL syncs at checkpoints instead of every commit
+        cursor.execute(f'PRAGMA journal_mode={config["SQLITE_JOURNAL_MODE"]}')
+        cursor.execute(f'PRAGMA synchronous={config["SQLITE_SYNCHRONOUS"]}')
+        cursor.execute(f'PRAGMA busy_timeout={int(config["SQLITE_BUSY_TIMEOUT"])}')
+    finally:
+        cursor.close()
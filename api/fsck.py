@@ -0,0 +1,166 @@
+"""Consistency check of the blob store against the database, run with `python -m api.fsck [--fix]`
+
+The store is split in 256 shards by the first two hex digits of the hash and
+the shards are checked independently on a process pool. A worker lists its
+shard in the backend and streams the blob rows of the same hash range, so it
+holds one shard at a time and only the problems travel back. It finds
+
+    orphaned    objects in the store without a blob row
+    missing     blob rows whose object is not in the store
+    dangling    files whose blob row is gone
+    size        objects whose size is not the stored_size of their row
+    refcount    blob rows whose refcount is not the number of files on them
+    file_size   files whose size is not the size of their blob
+
+With fix, orphans older than FSCK_GRACE seconds are removed, refcounts are
+recounted and blobs without files collected, a size mismatch is corrected if
+the object still hashes right (else it is reported as corrupt) and file sizes
+are taken from their blob, with the usage counters recounted after. Missing,
+dangling and corrupt blobs are only reported, their bytes are gone. It is safe
+to run next to the app.
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from api import app, db, storage, migrations
+from api.models import Blob, File
+
+PROBLEMS = ('orphaned', 'missing', 'dangling', 'size', 'corrupt', 'refcount', 'file_size')
+SHARDS = [f'{number:02x}' for number in range(256)]
+YIELD_PER = 1000
+# what a worker process needs to reach the same database and store
+CONFIG_PREFIXES = ('SQLALCHEMY_', 'SQLITE_', 'DB_', 'STORAGE_', 'S3_', 'UPLOAD_FOLDER', 'FSCK_')
+
+
+def in_shard(column, shard):
+    return column >= shard, column < shard[:-1] + chr(ord(shard[-1]) + 1)
+
+
+def content_hash(digest, encoding):
+    sha256 = hashlib.sha256()
+    with storage.open_blob(digest, encoding) as stream:
+        for chunk in iter(lambda: stream.read(storage.CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def check_shard(shard, fix=False):
+    """the problems of one shard, fixed as far as they can be with fix"""
+    report = {kind: [] for kind in PROBLEMS}
+    report['fixed'] = 0
+    # the store is listed before the rows are read: an object is put only after its row is committed
+    stored = {key.rsplit('/', 1)[-1]: (size, mtime) for key, size, mtime in storage.get_backend().scan(shard)}
+    references = db.session.query(db.func.count(File.id)).filter(File.blob_hash == Blob.hash).correlate(Blob)
+    rows = db.session.query(Blob.hash, Blob.stored_size, Blob.encoding, Blob.refcount, references.as_scalar()) \
+        .filter(*in_shard(Blob.hash, shard)).yield_per(YIELD_PER)
+    for digest, stored_size, encoding, refcount, files in rows:
+        found = stored.pop(digest, None)
+        if found is None:
+            report['missing'].append((digest,))
+        elif found[0] != stored_size:
+            report['size'].append((digest, encoding, stored_size, found[0]))
+        if refcount != files:
+            report['refcount'].append((digest, refcount, files))
+    now = time.time()
+    for digest, (size, mtime) in stored.items():
+        if mtime is None or now - mtime > app.config['FSCK_GRACE']:
+            report['orphaned'].append((digest, size))
+    report['dangling'] = [tuple(row) for row in
+                          db.session.query(File.id, File.blob_hash)
+                          .outerjoin(Blob, Blob.hash == File.blob_hash)
+                          .filter(Blob.hash.is_(None), *in_shard(File.blob_hash, shard)).yield_per(YIELD_PER)]
+    report['file_size'] = [tuple(row) for row in
+                           db.session.query(File.id, File.size, Blob.size)
+                           .join(Blob, Blob.hash == File.blob_hash)
+                           .filter(File.size != Blob.size, *in_shard(File.blob_hash, shard)).yield_per(YIELD_PER)]
+    if fix:
+        repair(report, references)
+    return report
+
+
+def repair(report, references):
+    fixed = 0
+    for digest, _ in report['orphaned']:
+        # a row may have come since the listing
+        if Blob.query.get(digest) is None:
+            storage.remove(digest)
+            fixed += 1
+    for digest, encoding, _, actual in report['size']:
+        if content_hash(digest, encoding) != digest:
+            report['corrupt'].append((digest,))
+            continue
+        Blob.query.filter_by(hash=digest).update({Blob.stored_size: actual}, synchronize_session=False)
+        File.query.filter_by(blob_hash=digest).update({File.stored_size: actual}, synchronize_session=False)
+        fixed += 1
+    for digest, _, _ in report['refcount']:
+        # recounted in the UPDATE itself, a copy or upload meanwhile is not lost
+        Blob.query.filter_by(hash=digest).update({Blob.refcount: references.as_scalar()}, synchronize_session=False)
+        fixed += 1
+    for file_id, _, size in report['file_size']:
+        File.query.filter_by(id=file_id).update({File.size: size}, synchronize_session=False)
+        fixed += 1
+    db.session.commit()
+    for digest, _, _ in report['refcount']:
+        Blob.collect(digest)
+    report['fixed'] = fixed
+
+
+def configure(settings):
+    app.config.update(settings)
+    storage.set_backend(None)
+
+
+def run_shard(shard, fix):
+    with app.app_context():
+        try:
+            return check_shard(shard, fix)
+        finally:
+            db.session.remove()
+
+
+def check(fix=False, workers=None):
+    """checks all shards, on workers processes or in this one with none; returns the problems of all of them"""
+    report = {kind: [] for kind in PROBLEMS}
+    report['fixed'] = 0
+    # a memory store is not shared with other processes
+    if not workers or app.config['STORAGE_BACKEND'] == 'memory':
+        results = (check_shard(shard, fix) for shard in SHARDS)
+        merge(report, results)
+    else:
+        settings = {key: value for key, value in app.config.items() if key.startswith(CONFIG_PREFIXES)}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=configure, initargs=(settings,)) as pool:
+            merge(report, pool.map(run_shard, SHARDS, [fix] * len(SHARDS), chunksize=8))
+    if fix and report['file_size']:
+        with db.engine.begin() as connection:
+            migrations.recount_usage(connection)
+    return report
+
+
+def merge(report, results):
+    for result in results:
+        for kind in PROBLEMS:
+            report[kind].extend(result[kind])
+        report['fixed'] += result['fixed']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='checks the blob store against the database')
+    parser.add_argument('--fix', action='store_true', help='repair what can be repaired')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes, 0 to check in this one')
+    args = parser.parse_args(argv)
+    report = check(args.fix, args.workers)
+    for kind in PROBLEMS:
+        for problem in report[kind]:
+            print(kind, *problem)
+    print(', '.join(f'{len(report[kind])} {kind}' for kind in PROBLEMS) + f', {report["fixed"]} fixed')
+    unfixed = ('missing', 'dangling', 'corrupt') if args.fix else PROBLEMS
+    return 1 if any(report[kind] for kind in unfixed) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
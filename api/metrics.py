@@ -0,0 +1,148 @@
+import os
+import time
+import random
+import cProfile
+import threading
+from functools import wraps
+from collections import defaultdict
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from api import app
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 25, 50, 100)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.query_seconds = defaultdict(float)
+        self.errors = defaultdict(int)
+        self.bytes_in = defaultdict(int)
+        self.bytes_out = defaultdict(int)
+
+    def observe_call(self, method, elapsed, queries, query_seconds, failed):
+        with self.lock:
+            self.latency[method].observe(elapsed)
+            self.queries[method].observe(queries)
+            self.query_seconds[method] += query_seconds
+            if failed:
+                self.errors[method] += 1
+
+    def observe_transfer(self, endpoint, bytes_in, bytes_out):
+        with self.lock:
+            self.bytes_in[endpoint] += bytes_in
+            self.bytes_out[endpoint] += bytes_out
+
+    def render(self):
+        with self.lock:
+            lines = ['# TYPE filebox_rpc_latency_seconds histogram']
+            for method, histogram in sorted(self.latency.items()):
+                lines += histogram.render('filebox_rpc_latency_seconds', f'method="{method}"')
+            lines.append('# TYPE filebox_rpc_sql_queries histogram')
+            for method, histogram in sorted(self.queries.items()):
+                lines += histogram.render('filebox_rpc_sql_queries', f'method="{method}"')
+            lines += counter('filebox_rpc_sql_seconds_total', 'method', self.query_seconds)
+            lines += counter('filebox_rpc_errors_total', 'method', self.errors)
+            lines += counter('filebox_http_received_bytes_total', 'endpoint', self.bytes_in)
+            lines += counter('filebox_http_sent_bytes_total', 'endpoint', self.bytes_out)
+            return lines
+
+
+def counter(name, label, values):
+    lines = [f'# TYPE {name} counter']
+    lines += [f'{name}{{{label}="{key}"}} {value}' for key, value in sorted(values.items())]
+    return lines
+
+
+registry = Registry()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        started = getattr(context, '_query_started', None)
+        if started is not None:
+            g.sql_seconds = g.get('sql_seconds', 0.0) + time.perf_counter() - started
+
+
+def instrument(method, f):
+    """records latency and sql use of every call, and profiles a PROFILE_SAMPLE_RATE share of them"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.rpc_methods = g.get('rpc_methods', []) + [method]
+        queries, query_seconds = g.get('sql_queries', 0), g.get('sql_seconds', 0.0)
+        started = time.perf_counter()
+        failed = True
+        try:
+            if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+                result = profiled(method, f, *args, **kwargs)
+            else:
+                result = f(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            registry.observe_call(method, time.perf_counter() - started, g.get('sql_queries', 0) - queries,
+                                  g.get('sql_seconds', 0.0) - query_seconds, failed)
+    return decorated
+
+
+def profiled(method, f, *args, **kwargs):
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(f, *args, **kwargs)
+    finally:
+        os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        profile.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], f'{method}-{time.time():.6f}.prof'))
+
+
+@app.after_request
+def record_transfer(response):
+    methods = g.get('rpc_methods', [])
+    if len(methods) == 1:
+        endpoint = methods[0]
+    elif methods:
+        endpoint = 'batch'
+    else:
+        endpoint = request.endpoint or 'unknown'
+    # streamed bodies have no length up front, Content-Length is what goes out
+    registry.observe_transfer(endpoint, request.content_length or 0, response.content_length or 0)
+    return response
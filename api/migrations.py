@@ -0,0 +1,174 @@
+"""Versioned schema migrations, run with `python -m api.migrations`
+
+An empty database gets the current schema from the models and is stamped with
+the latest version. A database with tables but no schema_version table is the
+schema the app first shipped with, version 0, and is upgraded step by step.
+Each step commits together with its version number.
+"""
+import os
+import shutil
+from collections import Counter
+from sqlalchemy import MetaData, Table, Column, Integer, select, func, inspect
+from api import app, db, storage, search
+
+schema_version = Table('schema_version', MetaData(), Column('version', Integer, nullable=False))
+
+
+def current_version(connection):
+    """None for an empty database"""
+    tables = inspect(connection).get_table_names()
+    if 'schema_version' not in tables:
+        return 0 if tables else None
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def stamp(connection, version):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def add_columns(connection, table_name, column_names):
+    """ALTER TABLE ADD COLUMN for the model columns the table does not have yet"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    for name in column_names:
+        if name in existing:
+            continue
+        column = db.metadata.tables[table_name].c[name]
+        ddl = f'ALTER TABLE {quote(connection, table_name)} ADD COLUMN {quote(connection, name)} ' \
+              f'{column.type.compile(connection.dialect)}'
+        if column.server_default is not None:
+            ddl += f' DEFAULT {column.server_default.arg}'
+        connection.execute(ddl)
+
+
+def create_indexes(connection):
+    """the model indexes missing from tables that exist"""
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+def import_legacy_files(connection):
+    """copies the files of the flat UPLOAD_FOLDER layout into the blob store.
+    the originals stay where they are, to be removed once the upgrade is checked"""
+    file, blob = db.metadata.tables['file'], db.metadata.tables['blob']
+    legacy = connection.execute(select([file.c.id, file.c.inner_name, file.c.public_name])
+                                .where(file.c.blob_hash.is_(None))).fetchall()
+    for file_id, inner_name, public_name in legacy:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], inner_name)
+        if not os.path.isfile(path):
+            app.logger.warning('file %s has no content at %s, left without a blob', file_id, path)
+            continue
+        digest, size = storage.hash_file(path)
+        stored_size = connection.execute(select([blob.c.stored_size]).where(blob.c.hash == digest)).scalar()
+        if stored_size is None:
+            temp = storage.temp_path()
+            shutil.copyfile(path, temp)
+            encoding, stored_size = storage.store(temp, digest, public_name)
+            connection.execute(blob.insert().values(hash=digest, size=size, stored_size=stored_size,
+                                                    encoding=encoding, refcount=1))
+        else:
+            connection.execute(blob.update().where(blob.c.hash == digest).values(refcount=blob.c.refcount + 1))
+        connection.execute(file.update().where(file.c.id == file_id)
+                           .values(blob_hash=digest, size=size, stored_size=stored_size))
+
+
+def recount_usage(connection):
+    """sets the user and folder subtree counters from the file sizes, leaving out the
+    folders Delete.folder detached (owner_id NULL), they were uncharged already"""
+    user, folder, file = (db.metadata.tables[name] for name in ('user', 'folder', 'file'))
+    owned = select([func.coalesce(func.sum(file.c.size), 0)]) \
+        .select_from(file.join(folder, folder.c.id == file.c.folder_id)) \
+        .where(db.and_(file.c.owner_id == user.c.id, folder.c.owner_id == user.c.id)).as_scalar()
+    connection.execute(user.update().values(used_bytes=owned))
+    direct = dict(connection.execute(select([file.c.folder_id, func.sum(file.c.size)])
+                                     .group_by(file.c.folder_id)).fetchall())
+    folders = connection.execute(select([folder.c.id, folder.c.owner_id, folder.c.path])
+                                 .where(folder.c.owner_id.isnot(None))).fetchall()
+    ids = {(owner_id, path): folder_id for folder_id, owner_id, path in folders}
+    totals = Counter()
+    for folder_id, owner_id, path in folders:
+        parts = path.split('/')
+        for i in range(1, len(parts) + 1):
+            ancestor = ids.get((owner_id, '/'.join(parts[:i])))
+            if ancestor is not None:
+                totals[ancestor] += direct.get(folder_id) or 0
+    connection.execute(folder.update().values(used_bytes=0))
+    for folder_id, total in totals.items():
+        if total:
+            connection.execute(folder.update().where(folder.c.id == folder_id).values(used_bytes=total))
+
+
+def blobs_and_counters(connection):
+    for name in ('blob', 'upload_session'):
+        db.metadata.tables[name].create(connection, checkfirst=True)
+    add_columns(connection, 'user', ('used_bytes', 'quota'))
+    add_columns(connection, 'folder', ('used_bytes',))
+    add_columns(connection, 'file', ('size', 'stored_size', 'blob_hash'))
+    if connection.dialect.name == 'postgresql':
+        # sqlite neither enforces lengths nor compares by column type
+        connection.execute('ALTER TABLE "user" ALTER COLUMN password TYPE VARCHAR(256)')
+        connection.execute('ALTER TABLE folder ALTER COLUMN parent TYPE INTEGER USING parent::integer')
+        connection.execute('ALTER TABLE folder ALTER COLUMN path TYPE VARCHAR(1024) COLLATE "C"')
+    create_indexes(connection)
+    import_legacy_files(connection)
+    recount_usage(connection)
+
+
+def upload_receipts(connection):
+    db.metadata.tables['upload_receipt'].create(connection, checkfirst=True)
+
+
+def search_index(connection):
+    search.build(connection)
+
+
+def path_trigram_index(connection):
+    if connection.dialect.name == 'postgresql':
+        for statement in search.CREATE_TRIGRAM_INDEXES:
+            connection.execute(statement)
+
+
+# (version, description, step), in order. steps check before they change:
+# a database made by create_all() has the newer schema already
+MIGRATIONS = [
+    (1, 'content addressed blobs, upload sessions, usage counters and listing indexes', blobs_and_counters),
+    (2, 'idempotency keys of Upload.file', upload_receipts),
+    (3, 'search index of file names and folder paths', search_index),
+    (4, 'trigram index of folder paths on postgresql', path_trigram_index),
+]
+
+
+def upgrade():
+    """brings the database to the latest version and returns it"""
+    with db.engine.begin() as connection:
+        version = current_version(connection)
+        if version is None:
+            db.metadata.create_all(connection)
+            version = MIGRATIONS[-1][0]
+        schema_version.create(connection, checkfirst=True)
+        stamp(connection, version)
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        app.logger.info('migrating to version %s: %s', number, description)
+        with db.engine.begin() as connection:
+            step(connection)
+            stamp(connection, number)
+        version = number
+    return version
+
+
+if __name__ == '__main__':
+    from api import models
+    print(f'database is at version {upgrade()}')
@@ -2,22 +2,28 @@ import os
 import datetime
 import base64
 import uuid
-from api import app, db
-from werkzeug.security import generate_password_hash
+import json
+from collections import Counter, defaultdict
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql
+from api import app, db, storage, checksums, security, thumbnails, search, counters
 
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, index=True)
-    password = db.Column(db.String(50))
+    password = db.Column(db.String(256))
     admin = db.Column(db.Boolean)
+    used_bytes = db.Column(db.BigInteger, default=0, server_default='0')
+    quota = db.Column(db.BigInteger)  # None falls back to DEFAULT_QUOTA
 
     @staticmethod
     def create_user(username, password):
         check_user = User.query.filter_by(name=username).first()
         if check_user:
             return {"message": "username is already exists. please choose another username"}
-        hashed_password = generate_password_hash(password, method='sha256')
+        hashed_password = security.hash_password(password)
         new_user = User(name=username, password=hashed_password, admin=False)
         db.session.add(new_user)
         new_user = User.query.filter_by(name=username).first()
@@ -26,35 +32,134 @@ class User(db.Model):
         db.session.commit()
         return {"message": "user has been created with default folder"}
 
+    def check_password(self, password):
+        """verifies on the password pool, a hash of an older kind or cost is replaced on success"""
+        if not security.check_password(self.password, password):
+            return False
+        if security.needs_rehash(self.password):
+            try:
+                self.password = security.hash_password(password)
+                db.session.commit()
+            except security.PasswordPoolBusy:
+                # the login stands, the rehash waits for a quieter one
+                pass
+        return True
+
+    @staticmethod
+    def quota_limit():
+        if app.config['DEFAULT_QUOTA'] is None:
+            return User.quota
+        return db.func.coalesce(User.quota, app.config['DEFAULT_QUOTA'])
+
+    @staticmethod
+    def has_room(owner_id, size):
+        """cheap check before any bytes are decoded, charge() is the one that counts"""
+        limit = User.quota_limit()
+        return db.session.query(User.id).filter(User.id == owner_id, db.or_(
+            limit.is_(None), User.used_bytes + size <= limit)).first() is not None
+
+    @staticmethod
+    def charge(owner_id, delta):
+        """adds delta bytes to the usage of the user in one UPDATE that refuses to pass the quota"""
+        query = User.query.filter(User.id == owner_id)
+        if delta > 0:
+            limit = User.quota_limit()
+            query = query.filter(db.or_(limit.is_(None), User.used_bytes + delta <= limit))
+        return query.update({User.used_bytes: User.used_bytes + delta}, synchronize_session=False) == 1
+
+    @staticmethod
+    def usage(owner_id, path=None):
+        user = db.session.query(User.used_bytes, User.quota_limit().label('quota')).filter(User.id == owner_id).one()
+        if path is None:
+            return {"used": user.used_bytes, "quota": user.quota}
+        folder = db.session.query(Folder.used_bytes).filter_by(path=path, owner_id=owner_id).first()
+        if folder is None:
+            return {"message": "folder is not exists"}
+        return {"path": path, "used": folder.used_bytes, "quota": user.quota}
+
 
 class Folder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), index=True)
-    parent = db.Column(db.String(1024))
-    path = db.Column(db.String(1024))
+    parent = db.Column(db.Integer, db.ForeignKey('folder.id'))
+    # byte order on every database, the subtree range scans depend on it
+    path = db.Column(db.String(1024).with_variant(postgresql.VARCHAR(1024, collation='C'), 'postgresql'))
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    used_bytes = db.Column(db.BigInteger, default=0, server_default='0')  # the whole subtree
+    __table_args__ = (db.Index('ix_folder_owner_path', 'owner_id', 'path', unique=True),
+                      db.Index('ix_folder_parent_name', 'parent', 'name'))
 
     @staticmethod
-    def user_folders(path, owner_id):
+    def subtree_filter(path):
+        """the folder at path and everything below it, as range scans over ix_folder_owner_path"""
+        return db.or_(Folder.path == path, db.and_(Folder.path >= f'{path}/', Folder.path < f'{path}0'))
+
+    @staticmethod
+    def ancestor_paths(path):
+        """the folder itself and every folder above it"""
+        parts = path.split('/')
+        return ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+    @staticmethod
+    def charge(owner_id, path, delta):
+        """adds delta bytes to the subtree counters of the folder and its ancestors"""
+        if delta:
+            Folder.query.filter(Folder.owner_id == owner_id, Folder.path.in_(Folder.ancestor_paths(path))) \
+                .update({Folder.used_bytes: Folder.used_bytes + delta}, synchronize_session=False)
+
+    @staticmethod
+    def user_folders(path, owner_id, limit=None, cursor=None, sort='name', order='asc', fields=None):
         folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
         if folder is None:
             return {"message": "folder is not exists"}
-        files_in = File.query.filter_by(folder_id=folder.id).all()
-        folders_in = Folder.query.filter_by(parent=folder.id)
         folder_data = {}
         folder_data['current_folder'] = folder.name
         folder_data['parent_folder'] = folder.parent
         folder_data['path'] = folder.path
-        folder_data['folders_in'] = [folder.name for folder in folders_in] or 'folders is not created'
-        folder_data['files_in'] = [file.public_name for file in files_in] or 'files is not uploaded'
+        if limit is not None:
+            page = File.list_page(folder.id, limit=limit, cursor=cursor, sort=sort, order=order, fields=fields)
+            if 'message' in page:
+                return page
+            if cursor is None:
+                folder_data['folders_in'] = Folder.child_names(folder.id)
+            folder_data.update(page)
+            return folder_data
+        files_in = db.session.query(File.public_name).filter_by(folder_id=folder.id).yield_per(1000)
+        folder_data['folders_in'] = Folder.child_names(folder.id) or 'folders is not created'
+        folder_data['files_in'] = [name for name, in files_in] or 'files is not uploaded'
         return folder_data
 
+    @staticmethod
+    def child_names(folder_id):
+        folders_in = db.session.query(Folder.name).filter_by(parent=folder_id).order_by(Folder.name)
+        return [name for name, in folders_in]
+
+    @staticmethod
+    def user_tree(path, owner_id):
+        folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
+        if folder is None:
+            return {"message": "folder is not exists"}
+        in_subtree = db.and_(Folder.owner_id == owner_id, Folder.subtree_filter(path))
+        folders = db.session.query(Folder.path).filter(in_subtree).order_by(Folder.path)
+        files = db.session.query(Folder.path, File.public_name, Blob.size) \
+            .join(File, File.folder_id == Folder.id).outerjoin(Blob, Blob.hash == File.blob_hash) \
+            .filter(in_subtree).order_by(Folder.path, File.public_name)
+        tree_data = {}
+        tree_data['path'] = folder.path
+        tree_data['folders'] = [folder_path for folder_path, in folders if folder_path != path]
+        tree_data['files'] = []
+        tree_data['size'] = 0
+        for folder_path, name, size in files:
+            tree_data['files'].append(f'{folder_path}/{name}')
+            tree_data['size'] += size or 0
+        return tree_data
+
     @staticmethod
     def create_folder(name, path, owner_id):
         current_folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
         if current_folder is None:
             return {"message": "you choose wrong folder path"}
-        check_folder = Folder.query.filter_by(name=name, path=f'{path}/{name}').first()
+        check_folder = Folder.query.filter_by(path=f'{path}/{name}', owner_id=owner_id).first()
         if check_folder is not None:
             return {"message": "folder is exists"}
         new_folder = Folder(parent=current_folder.id, owner_id=owner_id,
@@ -63,6 +168,99 @@ class Folder(db.Model):
         db.session.commit()
         return {'message': "folder is created"}
 
+    @staticmethod
+    def move_folder(path, newpath, owner_id, name=None):
+        """moves the folder at path into newpath, renamed to name if given,
+        with one UPDATE for the paths of the whole subtree"""
+        folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
+        if folder is None or folder.parent is None:
+            return {"message": "folder is not available"}
+        new_parent = Folder.query.filter_by(path=newpath, owner_id=owner_id).first()
+        if new_parent is None:
+            return {"message": "destination folder is not available"}
+        name = name or folder.name
+        if '/' in name:
+            return {"message": "wrong folder name"}
+        if newpath == path or newpath.startswith(f'{path}/'):
+            return {"message": "folder can not be moved into itself"}
+        new_path = f'{newpath}/{name}'
+        if Folder.query.filter_by(path=new_path, owner_id=owner_id).first() is not None:
+            return {"message": "folder is exists"}
+        Folder.charge(owner_id, path.rpartition('/')[0], -folder.used_bytes)
+        Folder.charge(owner_id, newpath, folder.used_bytes)
+        moved_path = db.literal(new_path) + db.func.substr(Folder.path, len(path) + 1)
+        Folder.query.filter(Folder.owner_id == owner_id, Folder.subtree_filter(path)) \
+            .update({Folder.path: moved_path}, synchronize_session=False)
+        moved_files = db.session.query(File.id).join(Folder, Folder.id == File.folder_id) \
+            .filter(Folder.owner_id == owner_id, Folder.subtree_filter(new_path))
+        search.move(db.session, moved_files.subquery(), path, new_path)
+        Folder.query.filter_by(id=folder.id).update({Folder.parent: new_parent.id, Folder.name: name},
+                                                    synchronize_session=False)
+        db.session.commit()
+        return {"path": new_path, "message": "folder has been moved"}
+
+    @staticmethod
+    def delete_folder(path, owner_id):
+        """detaches the subtree from its owner and gives the space back at once,
+        the files and blobs go later with reap_deleted()"""
+        folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
+        if folder is None or folder.parent is None:
+            return {"message": "folder is not available"}
+        subtree = db.session.query(Folder.id).filter(Folder.owner_id == owner_id, Folder.subtree_filter(path))
+        files = db.session.query(File.id).filter(File.folder_id.in_(subtree.subquery()))
+        # a public link must stop working now, not when the reaper gets to it
+        PublicLinks.query.filter(PublicLinks.file_id.in_(files.subquery())).delete(synchronize_session=False)
+        User.charge(owner_id, -folder.used_bytes)
+        Folder.charge(owner_id, path.rpartition('/')[0], -folder.used_bytes)
+        Folder.query.filter_by(id=folder.id).update({Folder.parent: None}, synchronize_session=False)
+        Folder.query.filter(Folder.owner_id == owner_id, Folder.subtree_filter(path)) \
+            .update({Folder.owner_id: None}, synchronize_session=False)
+        db.session.commit()
+        return {"path": path, "message": "folder has been deleted"}
+
+    @staticmethod
+    def reap_deleted(batch_size=None):
+        """deletes the files, upload sessions and folders of detached subtrees in batches
+        of FOLDER_REAP_BATCH, releasing the blobs; returns how many files went"""
+        batch_size = batch_size or app.config['FOLDER_REAP_BATCH']
+        detached = db.session.query(Folder.id).filter(Folder.owner_id.is_(None))
+        reaped = 0
+        while True:
+            files = db.session.query(File.id, File.blob_hash).filter(File.folder_id.in_(detached.subquery())) \
+                .limit(batch_size).all()
+            if not files:
+                break
+            file_ids = [file_id for file_id, _ in files]
+            by_blob = defaultdict(list)
+            for file_id, digest in files:
+                by_blob[digest].append(file_id)
+            PublicLinks.query.filter(PublicLinks.file_id.in_(file_ids)).delete(synchronize_session=False)
+            # a reaper running next to this one may have taken some of the batch, it releases those
+            released = {}
+            for digest, ids in by_blob.items():
+                count = File.query.filter(File.id.in_(ids)).delete(synchronize_session=False)
+                if count:
+                    Blob.release(digest, count)
+                    released[digest] = count
+            search.remove(db.session, file_ids)
+            db.session.commit()
+            for digest in released:
+                Blob.collect(digest)
+            reaped += sum(released.values())
+        for session in UploadSession.query.filter(UploadSession.folder_id.in_(detached.subquery())):
+            if os.path.exists(session.temp_path):
+                os.remove(session.temp_path)
+            db.session.delete(session)
+        db.session.commit()
+        while True:
+            # deepest first, a folder never goes before its children
+            batch = detached.order_by(db.func.length(Folder.path).desc()).limit(batch_size)
+            count = Folder.query.filter(Folder.id.in_([folder_id for folder_id, in batch])) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            if count < batch_size:
+                return reaped
+
 
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -71,10 +269,77 @@ class File(db.Model):
     inner_name = db.Column(db.String(128), index=True)
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'))
-    personal_link = db.Column(db.String(512))
+    personal_link = db.Column(db.String(512))  # where it was uploaded, moves leave it as it is
     download_count = db.Column(db.Integer, default=0)
+    size = db.Column(db.BigInteger)
+    stored_size = db.Column(db.BigInteger)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blob.hash'), index=True)
+    blob = db.relationship('Blob')
+    __table_args__ = (db.Index('ix_file_folder_name', 'folder_id', 'public_name'),
+                      db.Index('ix_file_folder_timestamp', 'folder_id', 'timestamp'))
 
-    def upload_file(self, encoded_file, filename, owner_id, folder):
+    # listing fields and sort keys of View.user pages
+    COLUMNS = {'name': 'public_name', 'timestamp': 'timestamp', 'size': 'size', 'download_count': 'download_count'}
+
+    @staticmethod
+    def column(field):
+        if field == 'size':
+            # a legacy file left without content has no size
+            return db.func.coalesce(File.size, 0)
+        return getattr(File, File.COLUMNS[field])
+
+    @staticmethod
+    def encode_cursor(value, file_id):
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([value, file_id]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor, sort):
+        value, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == 'timestamp':
+            value = datetime.datetime.fromisoformat(value)
+        return value, int(file_id)
+
+    @staticmethod
+    def list_page(folder_id, limit, cursor=None, sort='name', order='asc', fields=None):
+        """one keyset page of the files in a folder, ordered by (sort, id)"""
+        fields = fields or ['name']
+        if sort not in File.COLUMNS or order not in ('asc', 'desc'):
+            return {"message": "wrong sort order"}
+        if any(field not in File.COLUMNS for field in fields):
+            return {"message": "wrong fields"}
+        try:
+            limit = max(1, min(int(limit), app.config['MAX_PAGE_SIZE']))
+        except (ValueError, TypeError):
+            return {"message": "limit is invalid"}
+        sort_column = File.column(sort)
+        query = db.session.query(File.id, sort_column, *[File.column(field) for field in fields]) \
+            .filter(File.folder_id == folder_id)
+        if cursor is not None:
+            try:
+                value, file_id = File.decode_cursor(cursor, sort)
+            except (ValueError, TypeError):
+                return {"message": "cursor is invalid"}
+            if order == 'asc':
+                query = query.filter(db.or_(sort_column > value, db.and_(sort_column == value, File.id > file_id)))
+            else:
+                query = query.filter(db.or_(sort_column < value, db.and_(sort_column == value, File.id < file_id)))
+        if order == 'asc':
+            query = query.order_by(sort_column, File.id)
+        else:
+            query = query.order_by(sort_column.desc(), File.id.desc())
+        files = []
+        last = next_cursor = None
+        for row in query.limit(limit + 1).yield_per(limit + 1):
+            if len(files) == limit:
+                next_cursor = File.encode_cursor(last[1], last[0])
+                break
+            last = row
+            files.append({field: row[2 + i] for i, field in enumerate(fields)})
+        return {'files': files, 'next_cursor': next_cursor}
+
+    def prepare(self, filename, owner_id, folder):
         self.timestamp = datetime.datetime.utcnow()
         self.public_name = filename
         self.folder_id = folder.id
@@ -83,13 +348,46 @@ class File(db.Model):
         self.personal_link = f'{folder.path}/{self.inner_name}'
         check_file = File.query.filter_by(folder_id=self.folder_id, owner_id=self.owner_id,
                                           public_name=self.public_name, inner_name=self.inner_name).first()
-        if check_file:
+        return check_file is None
+
+    def upload_file(self, encoded_file, filename, owner_id, folder, sha256=None, crc32c=None, idempotency_key=None):
+        if not self.prepare(filename, owner_id, folder):
             return {"message": "file already exists"}
+        if not User.has_room(owner_id, len(encoded_file.rstrip('=')) * 3 // 4):
+            return {"message": "quota exceeded"}
+        data = base64.decodebytes(bytes(encoded_file.encode()))
+        temp, digest, size = storage.write_temp(data)
+        if not checksums.matches(data, digest, sha256=sha256, crc32c_hex=crc32c):
+            os.remove(temp)
+            return {"message": "checksum mismatch", "sha256": digest}
+        if not User.charge(owner_id, size):
+            os.remove(temp)
+            db.session.rollback()
+            return {"message": "quota exceeded"}
+        Folder.charge(owner_id, folder.path, size)
+        blob = Blob.acquire(temp, digest, size, filename)
+        encoding = blob.encoding
+        self.attach(blob)
         db.session.add(self)
-        with open(f'{app.config["UPLOAD_FOLDER"]}/{self.inner_name}', "wb") as file:
-            file.write(base64.decodebytes(bytes(encoded_file.encode())))
-        db.session.commit()
-        return {"file": self.public_name, "message": "file has been uploaded"}
+        result = {"file": self.public_name, "message": "file has been uploaded"}
+        if idempotency_key is not None:
+            UploadReceipt.record(owner_id, idempotency_key, result)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent retry with the same key got there first
+            db.session.rollback()
+            receipt = UploadReceipt.find(owner_id, idempotency_key) if idempotency_key is not None else None
+            if receipt is None:
+                raise
+            return receipt
+        thumbnails.pregenerate(digest, encoding, filename)
+        return result
+
+    def attach(self, blob):
+        self.blob_hash = blob.hash
+        self.size = blob.size
+        self.stored_size = blob.stored_size
 
     @staticmethod
     def delete_file(path, filename, owner_id):
@@ -99,14 +397,26 @@ class File(db.Model):
         file = File.query.filter_by(folder_id=folder.id, owner_id=owner_id, public_name=filename).first()
         if file is None:
             return {"message": "file has not found"}
-        check_public_links = PublicLinks.query.filter_by(file_id=file.id).first()
-        if check_public_links:
-            db.session.delete(check_public_links)
-        db.session.delete(file)
+        name, digest, size = file.public_name, file.blob_hash, file.size or 0
+        if not File.remove(file):
+            db.session.rollback()
+            return {"message": "file has not found"}
+        Blob.release(digest)
+        User.charge(owner_id, -size)
+        Folder.charge(owner_id, folder.path, -size)
         db.session.commit()
-        real_file = os.path.join(app.config['UPLOAD_FOLDER'], file.inner_name)
-        os.remove(real_file)
-        return {"file": file.public_name, "message": "has been deleted"}
+        Blob.collect(digest)
+        return {"file": name, "message": "has been deleted"}
+
+    @staticmethod
+    def remove(file):
+        """deletes the row of file with its public link and search entry. False when a
+        concurrent delete got to it first, then its blob and charge are not this one's to release"""
+        PublicLinks.query.filter_by(file_id=file.id).delete(synchronize_session=False)
+        if not File.query.filter_by(id=file.id).delete(synchronize_session=False):
+            return False
+        search.remove(db.session, [file.id])
+        return True
 
     @staticmethod
     def move_file(oldpath, newpath, filename, owner_id):
@@ -120,13 +430,207 @@ class File(db.Model):
         if file is None:
             return {"message": "file is not available"}
         file.folder_id = new_folder.id
-        new_inner_name = f'{file.owner_id}_{file.folder_id}_{file.public_name}'
-        os.rename(os.path.join(app.config['UPLOAD_FOLDER'], file.inner_name),
-                  os.path.join(app.config['UPLOAD_FOLDER'], new_inner_name))
-        file.inner_name = new_inner_name
+        file.inner_name = f'{file.owner_id}_{file.folder_id}_{file.public_name}'
+        Folder.charge(owner_id, current_folder.path, -(file.size or 0))
+        Folder.charge(owner_id, new_folder.path, file.size or 0)
         db.session.commit()
         return {"message": "file has been moved"}
 
+    @staticmethod
+    def search(owner_id, query=None, path=None, prefix=False, in_path=False, min_size=None, max_size=None,
+               after=None, before=None, limit=None, cursor=None):
+        """files of the user by a substring (or prefix) of their name, or of their whole path with in_path,
+        within the subtree at path, by size and upload time; keyset pages ordered by name"""
+        try:
+            after = datetime.datetime.fromisoformat(after) if after else None
+            before = datetime.datetime.fromisoformat(before) if before else None
+            limit = max(1, min(int(limit or app.config['SEARCH_PAGE_SIZE']), app.config['MAX_PAGE_SIZE']))
+            min_size = int(min_size) if min_size is not None else None
+            max_size = int(max_size) if max_size is not None else None
+        except (ValueError, TypeError):
+            return {"message": "wrong filter"}
+        files = db.session.query(File.id, File.public_name, Folder.path, File.size, File.timestamp) \
+            .join(Folder, Folder.id == File.folder_id).filter(Folder.owner_id == owner_id)
+        if path:
+            files = files.filter(Folder.subtree_filter(path))
+        if query:
+            # a substring across the name and the path around it is no match for either column
+            if len(query) >= 3 and search.indexed() and not (in_path and '/' in query):
+                files = files.filter(File.id.in_(search.matching(query, in_path)))
+            pattern = search.like_pattern(query, prefix)
+            if in_path and not prefix:
+                files = files.filter((Folder.path + '/' + File.public_name).ilike(pattern, escape='\\'))
+            else:
+                files = files.filter(File.public_name.ilike(pattern, escape='\\'))
+        if min_size is not None:
+            files = files.filter(File.size >= min_size)
+        if max_size is not None:
+            files = files.filter(File.size <= max_size)
+        if after is not None:
+            files = files.filter(File.timestamp >= after)
+        if before is not None:
+            files = files.filter(File.timestamp < before)
+        if cursor is not None:
+            try:
+                name, file_id = File.decode_cursor(cursor, 'name')
+            except (ValueError, TypeError):
+                return {"message": "cursor is invalid"}
+            files = files.filter(db.or_(File.public_name > name,
+                                        db.and_(File.public_name == name, File.id > file_id)))
+        page = files.order_by(File.public_name, File.id).limit(limit + 1).all()
+        next_cursor = None
+        if len(page) > limit:
+            next_cursor = File.encode_cursor(page[limit - 1].public_name, page[limit - 1].id)
+        return {'files': [{'path': row.path, 'name': row.public_name, 'size': row.size, 'timestamp': row.timestamp}
+                          for row in page[:limit]],
+                'next_cursor': next_cursor}
+
+    @staticmethod
+    def copy_file(oldpath, newpath, filename, owner_id):
+        """a new file on the same blob, no bytes are copied"""
+        current_folder = Folder.query.filter_by(path=oldpath, owner_id=owner_id).first()
+        if current_folder is None:
+            return {"message": "folder is not available"}
+        new_folder = Folder.query.filter_by(path=newpath, owner_id=owner_id).first()
+        if new_folder is None:
+            return {"message": "destination folder is not available"}
+        file = File.query.filter_by(folder_id=current_folder.id, owner_id=owner_id, public_name=filename).first()
+        if file is None:
+            return {"message": "file is not available"}
+        copy = File()
+        if not copy.prepare(filename, owner_id, new_folder):
+            return {"message": "file already exists"}
+        if not User.charge(owner_id, file.size or 0):
+            db.session.rollback()
+            return {"message": "quota exceeded"}
+        Folder.charge(owner_id, new_folder.path, file.size or 0)
+        Blob.query.filter_by(hash=file.blob_hash).update({Blob.refcount: Blob.refcount + 1},
+                                                         synchronize_session=False)
+        copy.blob_hash, copy.size, copy.stored_size = file.blob_hash, file.size, file.stored_size
+        db.session.add(copy)
+        db.session.commit()
+        return {"file": copy.public_name, "message": "file has been copied"}
+
+    @staticmethod
+    def check_items(items):
+        return isinstance(items, list) and len(items) <= app.config['MAX_BATCH_SIZE']
+
+    @staticmethod
+    def wrong_item(item, keys):
+        """whether a batch item misses one of keys or has a path or name that is not a string;
+        such an item gets its own error and the rest of the batch goes on"""
+        return not isinstance(item, dict) or not all(isinstance(item.get(key), str) for key in keys)
+
+    @staticmethod
+    def resolve(items, owner_id, path_keys):
+        """folders by path and files by (folder_id, filename) for a whole batch,
+        with one query for each instead of one per item"""
+        paths = {item[key] for item in items for key in path_keys}
+        folders = {folder.path: folder for folder in
+                   Folder.query.filter(Folder.owner_id == owner_id, Folder.path.in_(paths))}
+        wanted = {(folders[item[path_keys[0]]].id, item['filename'])
+                  for item in items if item[path_keys[0]] in folders}
+        if not wanted:
+            return folders, {}
+        query = File.query.filter(File.owner_id == owner_id,
+                                  File.folder_id.in_({folder_id for folder_id, _ in wanted}),
+                                  File.public_name.in_({filename for _, filename in wanted}))
+        return folders, {(file.folder_id, file.public_name): file for file in query
+                         if (file.folder_id, file.public_name) in wanted}
+
+    @staticmethod
+    def move_files(items, owner_id):
+        keys = ('oldpath', 'newpath', 'filename')
+        if not File.check_items(items):
+            return {"message": "wrong items"}
+        folders, files = File.resolve([item for item in items if not File.wrong_item(item, keys)],
+                                      owner_id, ('oldpath', 'newpath'))
+        moved = Counter()
+        results = []
+        for item in items:
+            if File.wrong_item(item, keys):
+                results.append({"message": "wrong item"})
+                continue
+            if item['oldpath'] not in folders:
+                results.append({"message": "folder is not available"})
+                continue
+            new_folder = folders.get(item['newpath'])
+            if new_folder is None:
+                results.append({"message": "destination folder is not available"})
+                continue
+            file = files.get((folders[item['oldpath']].id, item['filename']))
+            if file is None or file.folder_id != folders[item['oldpath']].id:
+                results.append({"message": "file is not available"})
+                continue
+            file.folder_id = new_folder.id
+            file.inner_name = f'{file.owner_id}_{file.folder_id}_{file.public_name}'
+            moved[item['oldpath']] -= file.size or 0
+            moved[new_folder.path] += file.size or 0
+            results.append({"message": "file has been moved"})
+        for folder_path, delta in moved.items():
+            Folder.charge(owner_id, folder_path, delta)
+        db.session.commit()
+        return {"results": results}
+
+    @staticmethod
+    def delete_files(items, owner_id):
+        keys = ('path', 'filename')
+        if not File.check_items(items):
+            return {"message": "wrong items"}
+        folders, files = File.resolve([item for item in items if not File.wrong_item(item, keys)],
+                                      owner_id, ('path',))
+        released = Counter()
+        freed = Counter()
+        results = []
+        for item in items:
+            if File.wrong_item(item, keys):
+                results.append({"message": "wrong item"})
+                continue
+            if item['path'] not in folders:
+                results.append({"message": "folder has not found"})
+                continue
+            file = files.pop((folders[item['path']].id, item['filename']), None)
+            if file is None:
+                results.append({"message": "file has not found"})
+                continue
+            name = file.public_name
+            if not File.remove(file):
+                results.append({"message": "file has not found"})
+                continue
+            released[file.blob_hash] += 1
+            freed[item['path']] += file.size or 0
+            results.append({"file": name, "message": "has been deleted"})
+        for digest, count in released.items():
+            Blob.release(digest, count)
+        for folder_path, size in freed.items():
+            Folder.charge(owner_id, folder_path, -size)
+        User.charge(owner_id, -sum(freed.values()))
+        db.session.commit()
+        for digest in released:
+            Blob.collect(digest)
+        return {"results": results}
+
+    @property
+    def real_path(self):
+        """path of the stored bytes, if they can be served as they are"""
+        if self.blob.encoding not in (None, 'identity'):
+            return None
+        return storage.blob_path(self.blob_hash)
+
+    def open(self):
+        return storage.open_blob(self.blob_hash, self.blob.encoding)
+
+    @staticmethod
+    def find_file(path, filename, owner_id):
+        folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
+        if folder is None:
+            return None
+        return File.query.filter_by(public_name=filename, folder_id=folder.id, owner_id=owner_id).first()
+
+    def count_download(self):
+        """counted in memory, the count is written with the next flush of counters.downloads"""
+        counters.downloads.record(self.id)
+
     @staticmethod
     def download_file(path, filename, owner_id):
         folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
@@ -135,44 +639,315 @@ class File(db.Model):
         file = File.query.filter_by(public_name=filename, folder_id=folder.id, owner_id=owner_id).first()
         if file is None:
             return {"message": "file is not available"}
-        file.download_count += 1
-        count = file.download_count
-        db.session.commit()
-        with open(f'{app.config["UPLOAD_FOLDER"]}/{file.inner_name}', "rb") as file:
-            encoded_file = base64.b64encode(file.read())
+        file.count_download()
+        encoded_file = base64.b64encode(storage.read_blob(file.blob_hash, file.blob.encoding))
+        count = (file.download_count or 0) + counters.downloads.unflushed(file.id)
         return {"download_count": count, "file": encoded_file.decode()}
 
+    @staticmethod
+    def download_thumbnail(path, filename, owner_id, size=None):
+        file = File.find_file(path=path, filename=filename, owner_id=owner_id)
+        if file is None:
+            return {"message": "file is not available"}
+        found = thumbnails.thumbnail(file.blob_hash, file.blob.encoding, file.public_name, size)
+        if found is None:
+            return {"message": "thumbnail is not available"}
+        size, data = found
+        return {"size": size, "mimetype": thumbnails.mimetype(data), "file": base64.b64encode(data).decode()}
+
+
+search.attach(File.__table__)
+
+
+@event.listens_for(File, 'after_insert')
+def index_file(mapper, connection, file):
+    search.add(connection, file.id, file.public_name, file.folder_id)
+
+
+@event.listens_for(File, 'after_update')
+def reindex_file(mapper, connection, file):
+    attrs = inspect(file).attrs
+    if attrs.public_name.history.has_changes() or attrs.folder_id.history.has_changes():
+        search.update(connection, file.id, file.public_name, file.folder_id)
+
+
+@event.listens_for(File, 'after_delete')
+def unindex_file(mapper, connection, file):
+    search.remove(connection, [file.id])
+
+
+class Blob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger)
+    stored_size = db.Column(db.BigInteger)
+    encoding = db.Column(db.String(16), default='identity')
+    refcount = db.Column(db.Integer, default=0)
+
+    @staticmethod
+    def acquire(temp, digest, size, filename=None):
+        """takes the temp file over: it becomes the blob, or is dropped if the content is already stored"""
+        path = temp
+        while True:
+            # the rowcount tells whether the row is still there, a collect may just have deleted it
+            if Blob.query.filter_by(hash=digest).update({Blob.refcount: Blob.refcount + 1},
+                                                        synchronize_session=False):
+                os.remove(path)
+                break
+            if path == temp:
+                path, encoding, stored_size = storage.prepare(temp, filename)
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(Blob.__table__.insert().values(
+                        hash=digest, size=size, stored_size=stored_size, encoding=encoding, refcount=1))
+            except IntegrityError:
+                # the same content came in first from another upload, that one stores the bytes
+                continue
+            # the bytes are renamed into place once the row is committed, see put_pending_blobs
+            db.session.info.setdefault('pending_blobs', []).append((path, digest))
+            break
+        # the session may still hold the instance of a collected row
+        return Blob.query.populate_existing().get(digest)
+
+    @staticmethod
+    def release(digest, count=1):
+        Blob.query.filter_by(hash=digest).update({Blob.refcount: Blob.refcount - count},
+                                                  synchronize_session=False)
+
+    @staticmethod
+    def collect(digest):
+        """drops the blob once nothing references it, to be called after the release is committed"""
+        if Blob.query.filter(Blob.hash == digest, Blob.refcount <= 0).delete(synchronize_session=False):
+            db.session.commit()
+            # an upload of the same content may have stored it again meanwhile
+            if db.session.query(Blob.hash).filter_by(hash=digest).first() is None:
+                storage.remove(digest)
+
+
+@event.listens_for(db.session, 'after_commit')
+def put_pending_blobs(session):
+    for path, digest in session.info.pop('pending_blobs', []):
+        storage.put(path, digest)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def drop_pending_blobs(session):
+    for path, digest in session.info.pop('pending_blobs', []):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class UploadReceipt(db.Model):
+    """the answer to an Upload.file with an idempotency key, replayed to retries with the same key"""
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    key = db.Column(db.String(128), primary_key=True)
+    timestamp = db.Column(db.DateTime, index=True)
+    result = db.Column(db.Text)
+
+    @staticmethod
+    def find(owner_id, key):
+        receipt = UploadReceipt.query.get((owner_id, key))
+        if receipt is None:
+            return None
+        return json.loads(receipt.result)
+
+    @staticmethod
+    def record(owner_id, key, result):
+        """adds the receipt to the session, it is committed along with the upload"""
+        db.session.add(UploadReceipt(owner_id=owner_id, key=key, timestamp=datetime.datetime.utcnow(),
+                                     result=json.dumps(result)))
+
+    @staticmethod
+    def sweep_expired():
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+        count = UploadReceipt.query.filter(UploadReceipt.timestamp <= expired).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+    filename = db.Column(db.String(64))
+    offset = db.Column(db.BigInteger, default=0)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'))
+
+    @property
+    def temp_path(self):
+        return storage.temp_path(self.id)
+
+    def begin(self, filename, owner_id, folder, size=None):
+        if not File().prepare(filename, owner_id, folder):
+            return {"message": "file already exists"}
+        if size is not None and not User.has_room(owner_id, int(size)):
+            return {"message": "quota exceeded"}
+        self.id = str(uuid.uuid4())
+        self.timestamp = datetime.datetime.utcnow()
+        self.filename = filename
+        self.offset = 0
+        self.owner_id = owner_id
+        self.folder_id = folder.id
+        open(self.temp_path, "wb").close()
+        db.session.add(self)
+        db.session.commit()
+        return {"session": self.id, "offset": self.offset, "chunk_size": app.config['UPLOAD_CHUNK_SIZE']}
+
+    @staticmethod
+    def append_chunk(session_id, offset, encoded_chunk, owner_id):
+        session = UploadSession.query.filter_by(id=session_id, owner_id=owner_id).first()
+        if session is None:
+            return {"message": "upload session is not found"}
+        if int(offset) != session.offset:
+            return {"message": "wrong offset", "offset": session.offset}
+        if not User.has_room(owner_id, session.offset + len(encoded_chunk.rstrip('=')) * 3 // 4):
+            return {"message": "quota exceeded"}
+        chunk = base64.decodebytes(bytes(encoded_chunk.encode()))
+        if len(chunk) > app.config['UPLOAD_CHUNK_SIZE']:
+            return {"message": "chunk is too large", "chunk_size": app.config['UPLOAD_CHUNK_SIZE']}
+        # a chunk written before a failed commit is simply overwritten by the retry
+        with open(session.temp_path, "r+b") as file:
+            file.seek(session.offset)
+            file.write(chunk)
+            file.truncate()
+        session.offset += len(chunk)
+        session.timestamp = datetime.datetime.utcnow()
+        db.session.commit()
+        return {"session": session.id, "offset": session.offset}
+
+    @staticmethod
+    def sweep_expired():
+        """drops the sessions idle for UPLOAD_SESSION_TTL seconds and their temp files, returns how many went"""
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['UPLOAD_SESSION_TTL'])
+        count = 0
+        for session in UploadSession.query.filter(UploadSession.timestamp <= expired):
+            if os.path.exists(session.temp_path):
+                os.remove(session.temp_path)
+            db.session.delete(session)
+            count += 1
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def commit_upload(session_id, owner_id):
+        session = UploadSession.query.filter_by(id=session_id, owner_id=owner_id).first()
+        if session is None:
+            return {"message": "upload session is not found"}
+        folder = Folder.query.filter_by(id=session.folder_id, owner_id=owner_id).first()
+        if folder is None:
+            return {"message": "folder has not found"}
+        file = File()
+        if not file.prepare(session.filename, owner_id, folder):
+            return {"message": "file already exists"}
+        with open(session.temp_path, "r+b") as temp:
+            temp.truncate(session.offset)
+        digest, size = storage.hash_file(session.temp_path)
+        if not User.charge(owner_id, size):
+            db.session.rollback()
+            return {"message": "quota exceeded"}
+        Folder.charge(owner_id, folder.path, size)
+        blob = Blob.acquire(session.temp_path, digest, size, session.filename)
+        encoding = blob.encoding
+        file.attach(blob)
+        db.session.add(file)
+        db.session.delete(session)
+        db.session.commit()
+        thumbnails.pregenerate(digest, encoding, file.public_name)
+        return {"file": file.public_name, "message": "file has been uploaded"}
+
 
 class PublicLinks(db.Model):
     upload_time = db.Column(db.DateTime)
-    expire = db.Column(db.DateTime)
+    expire = db.Column(db.DateTime, index=True)
     file_id = db.Column(db.Integer, db.ForeignKey('file.id'), primary_key=True)
     link = db.Column(db.String(512), unique=True)
 
     def share_file(self, path, filename, time, owner_id):
-        folder = Folder.query.filter_by(path=path, owner_id=owner_id).first()
-        file = File.query.filter_by(public_name=filename, folder_id=folder.id, owner_id=owner_id).first()
+        if PublicLinks.minutes(time) is None:
+            return {"message": "wrong time"}
+        file = File.find_file(path=path, filename=filename, owner_id=owner_id)
         if file is None:
             return {"message": "file is not found"}
-        check_file = PublicLinks.query.filter_by(file_id=file.id).first()
-        if check_file:
-            db.session.delete(check_file)
-            db.session.commit()
+        # an existing link of the file is renewed in place, in the same commit
+        link = PublicLinks.query.get(file.id) or self
+        link_data = link.assign(file, time)
+        db.session.add(link)
+        db.session.commit()
+        return link_data
+
+    @staticmethod
+    def minutes(time):
+        """the lifetime of a link in minutes, None unless it is a whole number the calendar can take"""
+        try:
+            minutes = int(time)
+            datetime.datetime.utcnow() + datetime.timedelta(minutes=minutes)
+        except (ValueError, TypeError, OverflowError):
+            return None
+        return minutes
+
+    def assign(self, file, time):
         self.upload_time = datetime.datetime.utcnow()
-        self.expire = self.upload_time + datetime.timedelta(minutes=int(time))
+        self.expire = self.upload_time + datetime.timedelta(minutes=PublicLinks.minutes(time))
         self.file_id = file.id
         self.link = f'{str(uuid.uuid4())}/{file.public_name}'
-        db.session.add(self)
-        db.session.commit()
         link_data = {}
         link_data['upload_time'] = self.upload_time
         link_data['expiration_time'] = self.expire
         link_data['public_link'] = self.link
         return link_data
 
+    @staticmethod
+    def resolve(link):
+        """the file behind a public link that has not expired yet"""
+        found = db.session.query(PublicLinks.expire, File).join(File, File.id == PublicLinks.file_id) \
+            .filter(PublicLinks.link == link).first()
+        if found is None or found.expire <= datetime.datetime.utcnow():
+            return None
+        return found.File
+
+    @staticmethod
+    def sweep_expired(batch_size=None):
+        """deletes expired links in batches of LINK_SWEEP_BATCH, returns how many went"""
+        batch_size = batch_size or app.config['LINK_SWEEP_BATCH']
+        now = datetime.datetime.utcnow()
+        deleted = 0
+        while True:
+            expired = db.session.query(PublicLinks.file_id).filter(PublicLinks.expire <= now).limit(batch_size)
+            count = PublicLinks.query.filter(PublicLinks.file_id.in_(expired.subquery())) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    @staticmethod
+    def share_files(items, owner_id):
+        keys = ('path', 'filename')
+        if not File.check_items(items):
+            return {"message": "wrong items"}
+        folders, files = File.resolve([item for item in items if not File.wrong_item(item, keys)],
+                                      owner_id, ('path',))
+        links = {}
+        file_ids = [file.id for file in files.values()]
+        if file_ids:
+            links = {link.file_id: link for link in PublicLinks.query.filter(PublicLinks.file_id.in_(file_ids))}
+        results = []
+        for item in items:
+            if File.wrong_item(item, keys) or PublicLinks.minutes(item.get('time')) is None:
+                results.append({"message": "wrong item"})
+                continue
+            folder = folders.get(item['path'])
+            file = files.get((folder.id, item['filename'])) if folder is not None else None
+            if file is None:
+                results.append({"message": "file is not found"})
+                continue
+            if file.id not in links:
+                links[file.id] = PublicLinks()
+                db.session.add(links[file.id])
+            results.append(links[file.id].assign(file, item['time']))
+        db.session.commit()
+        return {"results": results}
+
 
 if __name__ == '__main__':
-    db.drop_all()
-    db.session.commit()
-    db.create_all()
-    db.session.commit()
+    from api import migrations
+    migrations.upgrade()
@@ -0,0 +1,109 @@
+"""Search index of file names and folder paths
+
+On SQLite (3.34 or newer) it is the FTS5 table file_search with the trigram
+tokenizer, one row per file with the file id as rowid, so any substring of
+three or more characters is an index lookup. The mapper events in models keep
+it in step with the file table, and the set-based paths there call in here.
+On PostgreSQL the same queries are ILIKE over pg_trgm GIN indexes of the
+name and the folder path, each column matched on its own so either index
+serves, and there is nothing to keep in step.
+"""
+import sqlite3
+from sqlalchemy import DDL, MetaData, Table, Column, Integer, String, event
+from api import db
+
+FTS_TABLE = 'file_search'
+CREATE_FTS = f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(name, path, tokenize='trigram')"
+FILL_FTS = f'INSERT INTO {FTS_TABLE}(rowid, name, path) ' \
+           f'SELECT file.id, file.public_name, folder.path FROM file JOIN folder ON folder.id = file.folder_id'
+CREATE_TRIGRAM_INDEXES = ['CREATE EXTENSION IF NOT EXISTS pg_trgm',
+                          'CREATE INDEX IF NOT EXISTS ix_file_public_name_trgm ON file '
+                          'USING gin (public_name gin_trgm_ops)',
+                          'CREATE INDEX IF NOT EXISTS ix_folder_path_trgm ON folder '
+                          'USING gin (path gin_trgm_ops)']
+
+# for queries only, the table is made by CREATE_FTS
+file_search = Table(FTS_TABLE, MetaData(), Column('rowid', Integer), Column('name', String), Column('path', String))
+
+
+def has_fts(dialect):
+    return dialect.name == 'sqlite' and sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def enabled():
+    return has_fts(db.engine.dialect)
+
+
+def indexed():
+    """whether matching() is served by an index, FTS5 or pg_trgm"""
+    return enabled() or db.engine.dialect.name == 'postgresql'
+
+
+def like_pattern(text, prefix=False):
+    pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'{pattern}%' if prefix else f'%{pattern}%'
+
+
+def attach(table):
+    """creates and drops the index along with the file table"""
+    fts = lambda ddl, target, bind, **kw: has_fts(bind.dialect)
+    event.listen(table, 'after_create', DDL(CREATE_FTS).execute_if(callable_=fts))
+    event.listen(table, 'before_drop', DDL(f'DROP TABLE IF EXISTS {FTS_TABLE}').execute_if(callable_=fts))
+    for statement in CREATE_TRIGRAM_INDEXES:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
+def build(connection):
+    """the index from scratch, for databases made before it"""
+    if has_fts(connection.dialect):
+        connection.execute(CREATE_FTS)
+        connection.execute(file_search.delete())
+        connection.execute(FILL_FTS)
+    elif connection.dialect.name == 'postgresql':
+        for statement in CREATE_TRIGRAM_INDEXES:
+            connection.execute(statement)
+
+
+def folder_path(folder_id):
+    folder = db.metadata.tables['folder']
+    return db.select([folder.c.path]).where(folder.c.id == folder_id).as_scalar()
+
+
+def add(connection, file_id, name, folder_id):
+    if enabled():
+        connection.execute(file_search.insert().values(rowid=file_id, name=name, path=folder_path(folder_id)))
+
+
+def update(connection, file_id, name, folder_id):
+    if enabled():
+        connection.execute(file_search.update().where(file_search.c.rowid == file_id)
+                           .values(name=name, path=folder_path(folder_id)))
+
+
+def remove(connection, file_ids):
+    if enabled() and file_ids:
+        connection.execute(file_search.delete().where(file_search.c.rowid.in_(file_ids)))
+
+
+def move(connection, file_ids, old_path, new_path):
+    """rewrites the folder paths of the files in file_ids, a select, after a folder move"""
+    if enabled():
+        moved_path = db.literal(new_path) + db.func.substr(file_search.c.path, len(old_path) + 1)
+        connection.execute(file_search.update().where(file_search.c.rowid.in_(file_ids)).values(path=moved_path))
+
+
+def matching(text, in_path=False):
+    """a select of the ids of files whose name, or path too, contains text of 3 characters or more"""
+    if not enabled():
+        file, folder = db.metadata.tables['file'], db.metadata.tables['folder']
+        pattern = like_pattern(text)
+        by_name = db.select([file.c.id]).where(file.c.public_name.ilike(pattern, escape='\\'))
+        if not in_path:
+            return by_name
+        by_path = db.select([file.c.id]).select_from(file.join(folder, folder.c.id == file.c.folder_id)) \
+            .where(folder.c.path.ilike(pattern, escape='\\'))
+        return db.union(by_name, by_path)
+    phrase = '"' + text.replace('"', '""') + '"'
+    if not in_path:
+        phrase = f'name : {phrase}'
+    return db.select([file_search.c.rowid]).where(db.literal_column(FTS_TABLE).op('MATCH')(phrase))
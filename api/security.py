@@ -0,0 +1,134 @@
+"""Password hashing with a configurable KDF, run on a bounded process pool
+
+Hashes are `scrypt:n:r:p$salt$hex` (hashlib) or argon2 PHC strings (the
+argon2-cffi package). Older werkzeug hashes, e.g. `sha256$salt$hex`, still
+verify and are replaced on the next successful login. Every hash and check
+goes through the pool: a login storm takes PASSWORD_WORKERS cores at most, and
+past PASSWORD_QUEUE waiting logins the next one is refused instead of queued.
+"""
+import hmac
+import secrets
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash
+from api import app
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                          maxmem=132 * n * r * p, dklen=64).hex()
+
+
+def argon2_hasher(params=None):
+    if argon2 is None:
+        raise RuntimeError('argon2 hashes need the argon2-cffi package')
+    if params is None:
+        # verify() takes the cost from the hash itself
+        return argon2.PasswordHasher()
+    time_cost, memory_cost, parallelism = params
+    return argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+
+def make_hash(password, method, params):
+    if method == 'argon2':
+        return argon2_hasher(params).hash(password)
+    if method == 'scrypt':
+        n, r, p = params
+        salt = secrets.token_hex(8)
+        return f'scrypt:{n}:{r}:{p}${salt}${scrypt(password, salt, n, r, p)}'
+    raise ValueError(f'unknown password hash {method}')
+
+
+def verify(stored, password):
+    if stored.startswith('scrypt:'):
+        method, salt, hashed = stored.split('$', 2)
+        n, r, p = (int(value) for value in method.split(':')[1:])
+        return hmac.compare_digest(scrypt(password, salt, n, r, p), hashed)
+    if stored.startswith('$argon2'):
+        try:
+            return argon2_hasher().verify(stored, password)
+        except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHash):
+            return False
+    return check_password_hash(stored, password)
+
+
+class PasswordPool(object):
+    """runs KDF calls on worker processes, at most workers + queue of them at a time"""
+
+    def __init__(self, workers, queue, wait):
+        self.workers = workers
+        self.wait = wait
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawned, not forked: a forked worker closing inherited sqlite handles drops the parent's locks
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def run(self, func, *args):
+        if not self.slots.acquire(timeout=self.wait):
+            raise PasswordPoolBusy()
+        try:
+            executor = self.get_executor()
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                # a worker died, e.g. killed for memory; the pool is of no use after that
+                self.discard(executor)
+                return self.get_executor().submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def discard(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+pool = PasswordPool(app.config['PASSWORD_WORKERS'], app.config['PASSWORD_QUEUE'], app.config['PASSWORD_WAIT'])
+
+
+def hash_params():
+    if app.config['PASSWORD_HASH'] == 'argon2':
+        return app.config['ARGON2_TIME_COST'], app.config['ARGON2_MEMORY_COST'], app.config['ARGON2_PARALLELISM']
+    return app.config['SCRYPT_N'], app.config['SCRYPT_R'], app.config['SCRYPT_P']
+
+
+def hash_password(password):
+    return pool.run(make_hash, password, app.config['PASSWORD_HASH'], hash_params())
+
+
+def check_password(stored, password):
+    return pool.run(verify, stored, password)
+
+
+def needs_rehash(stored):
+    """whether the hash is of another kind or cost than the configured one"""
+    if app.config['PASSWORD_HASH'] == 'argon2':
+        return not stored.startswith('$argon2') or argon2_hasher(hash_params()).check_needs_rehash(stored)
+    n, r, p = hash_params()
+    return not stored.startswith(f'scrypt:{n}:{r}:{p}$')
@@ -0,0 +1,263 @@
+import io
+import os
+import uuid
+import hashlib
+import threading
+from api import app, compression
+
+CHUNK_SIZE = 1024*1024
+
+
+class LocalStorage(object):
+    """blobs as plain files in a sharded directory tree"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, key, path):
+        destination = self.local_path(key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(path, destination)
+        # the rename itself is only durable once the directory is synced
+        directory = os.open(os.path.dirname(destination), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def open(self, key):
+        return open(self.local_path(key), "rb")
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def scan(self, prefix):
+        """(key, size, mtime) of everything under the directory prefix, temp files left out"""
+        def walk(path):
+            try:
+                entries = list(os.scandir(path))
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from walk(entry.path)
+                elif not entry.name.endswith('.part'):
+                    stat = entry.stat(follow_symlinks=False)
+                    key = os.path.relpath(entry.path, self.root).replace(os.sep, '/')
+                    yield key, stat.st_size, stat.st_mtime
+        return walk(self.local_path(prefix))
+
+
+class MemoryStorage(object):
+    """keeps blobs in a dict, meant for tests"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def local_path(self, key):
+        return None
+
+    def put(self, key, path):
+        with open(path, "rb") as file:
+            data = file.read()
+        with self.lock:
+            self.blobs[key] = data
+        os.remove(path)
+
+    def open(self, key):
+        return io.BytesIO(self.blobs[key])
+
+    def exists(self, key):
+        return key in self.blobs
+
+    def size(self, key):
+        return len(self.blobs[key])
+
+    def delete(self, key):
+        with self.lock:
+            self.blobs.pop(key, None)
+
+    def scan(self, prefix):
+        with self.lock:
+            blobs = list(self.blobs.items())
+        return [(key, len(data), None) for key, data in blobs if key.startswith(prefix + '/')]
+
+
+class S3Storage(object):
+    """S3-compatible object storage (AWS, MinIO, moto).
+
+    One client is shared by all threads; botocore keeps a pool of
+    S3_MAX_POOL_CONNECTIONS keep-alive connections behind it. Files above
+    S3_MULTIPART_THRESHOLD go up as multipart uploads whose parts are sent
+    concurrently by the s3transfer thread pool.
+    """
+
+    def __init__(self, bucket, endpoint_url=None, region_name=None, max_pool_connections=10,
+                 multipart_threshold=8*1024*1024, multipart_chunksize=8*1024*1024, max_concurrency=4):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name,
+                                   config=Config(max_pool_connections=max_pool_connections))
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency)
+
+    def local_path(self, key):
+        return None
+
+    def put(self, key, path):
+        self.client.upload_file(path, self.bucket, key, Config=self.transfer_config)
+        os.remove(path)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return False
+        return True
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def scan(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix + '/'):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['Size'], item['LastModified'].timestamp()
+
+
+def create_backend(config):
+    kind = config['STORAGE_BACKEND']
+    if kind == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind == 's3':
+        return S3Storage(config['S3_BUCKET'], endpoint_url=config['S3_ENDPOINT_URL'],
+                         region_name=config['S3_REGION'],
+                         max_pool_connections=config['S3_MAX_POOL_CONNECTIONS'],
+                         multipart_threshold=config['S3_MULTIPART_THRESHOLD'],
+                         multipart_chunksize=config['S3_MULTIPART_CHUNKSIZE'])
+    raise ValueError(f'unknown storage backend {kind}')
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend(app.config)
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def blob_key(digest):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def blob_path(digest):
+    """path on local disk, or None when the backend has no files to point at"""
+    return get_backend().local_path(blob_key(digest))
+
+
+def temp_path(name=None):
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'{name or uuid.uuid4()}.part')
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+def write_temp(data):
+    path = temp_path()
+    with open(path, "wb") as file:
+        file.write(data)
+    return path, hashlib.sha256(data).hexdigest(), len(data)
+
+
+def fsync(path):
+    with open(path, "r+b") as file:
+        os.fsync(file.fileno())
+
+
+def prepare(path, filename=None):
+    """readies a finished temp file for the backend: compressed first when
+    STORAGE_COMPRESSION is set and it pays off, then synced to disk.
+    returns the file to put, its encoding and the size actually stored"""
+    encoding = compression.choose_encoding(filename, path, app.config['STORAGE_COMPRESSION'],
+                                           app.config['COMPRESSION_MAX_ENTROPY'])
+    if encoding is not None:
+        compressed = temp_path()
+        compression.compress(path, compressed, encoding, app.config['STORAGE_COMPRESSION_LEVEL'])
+        # not worth a decompression on every read below a tenth saved
+        if os.path.getsize(compressed) < os.path.getsize(path) * 0.9:
+            os.remove(path)
+            path = compressed
+        else:
+            os.remove(compressed)
+            encoding = None
+    fsync(path)
+    return path, encoding or 'identity', os.path.getsize(path)
+
+
+def put(path, digest):
+    """hands a prepared file over to the backend under its content hash"""
+    get_backend().put(blob_key(digest), path)
+
+
+def store(path, digest, filename=None):
+    """prepare() and put() in one go, returns the encoding and the stored size"""
+    path, encoding, stored_size = prepare(path, filename)
+    put(path, digest)
+    return encoding, stored_size
+
+
+def open_blob(digest, encoding=None):
+    return compression.decompressed(get_backend().open(blob_key(digest)), encoding)
+
+
+def read_blob(digest, encoding=None):
+    with open_blob(digest, encoding) as file:
+        return file.read()
+
+
+def exists(digest):
+    return get_backend().exists(blob_key(digest))
+
+
+def remove(digest):
+    get_backend().delete(blob_key(digest))
@@ -0,0 +1,57 @@
+import threading
+from api import app, db
+
+
+class PeriodicTask(threading.Thread):
+    """calls func every interval seconds in an app context until stopped,
+    and once more on the way out with at_stop"""
+
+    def __init__(self, name, interval, func, at_stop=False):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.func = func
+        self.at_stop = at_stop
+        self.stopped = threading.Event()
+
+    def run_once(self):
+        with app.app_context():
+            try:
+                self.func()
+            except Exception:
+                app.logger.exception('background task %s failed', self.name)
+            finally:
+                db.session.remove()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.run_once()
+        if self.at_stop:
+            self.run_once()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+_tasks = []
+
+
+def schedule(name, interval, func, at_stop=False):
+    _tasks.append(PeriodicTask(name, interval, func, at_stop))
+
+
+_start_lock = threading.Lock()
+
+
+def start(*names):
+    """starts the scheduled tasks, or those of names, that have not run yet"""
+    with _start_lock:
+        for task in _tasks:
+            if task.ident is None and (not names or task.name in names):
+                task.start()
+
+
+def stop():
+    for task in _tasks:
+        task.stop()
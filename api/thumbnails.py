@@ -0,0 +1,194 @@
+"""Thumbnails of image files, needs the Pillow package
+
+A thumbnail is made on the first request for it, or right after the upload
+for the THUMBNAIL_PREGENERATE sizes, on a small pool of worker threads. They
+are kept on disk by content hash and size, so every copy of the same image
+shares them, and the least recently used go once the cache passes
+THUMBNAIL_CACHE_SIZE bytes.
+"""
+import io
+import os
+import uuid
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from api import app, storage
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class ThumbnailCache(object):
+    """thumbnails as <root>/<aa>/<hash>-<size>, least recently used first out"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def path(self, digest, size):
+        return os.path.join(self.root, digest[:2], f'{digest}-{size}')
+
+    def load(self):
+        """takes over what earlier runs left, the last touched last"""
+        found = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.part'):
+                    path = os.path.join(directory, name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(found):
+            self.entries[path] = size
+            self.total += size
+        self.loaded = True
+
+    def get(self, digest, size):
+        path = self.path(digest, size)
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if path not in self.entries:
+                return None
+            self.entries.move_to_end(path)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            # the recency survives a restart
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            with self.lock:
+                self.total -= self.entries.pop(path, 0)
+            return None
+
+    def put(self, digest, size, data):
+        path = self.path(digest, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f'{path}.{uuid.uuid4()}.part'
+        with open(temp, "wb") as file:
+            file.write(data)
+        os.replace(temp, path)
+        evicted = []
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.total += len(data) - self.entries.pop(path, 0)
+            self.entries[path] = len(data)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old_path, old_size = self.entries.popitem(last=False)
+                self.total -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+
+_cache = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = ThumbnailCache(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_CACHE_SIZE'])
+        return _cache
+
+
+def set_cache(cache):
+    global _cache
+    with _lock:
+        _cache = cache
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                           thread_name_prefix='thumbnail')
+        return _executor
+
+
+def is_image(filename):
+    mimetype, _ = mimetypes.guess_type(filename or '')
+    return Image is not None and mimetype is not None and mimetype.startswith('image/')
+
+
+def snap(size):
+    """the smallest of THUMBNAIL_SIZES that fits size, so the cache holds a few sizes per image"""
+    sizes = sorted(app.config['THUMBNAIL_SIZES'])
+    try:
+        requested = int(size or app.config['THUMBNAIL_DEFAULT_SIZE'])
+    except ValueError:
+        requested = app.config['THUMBNAIL_DEFAULT_SIZE']
+    return next((allowed for allowed in sizes if allowed >= requested), sizes[-1])
+
+
+def mimetype(data):
+    return 'image/png' if data.startswith(b'\x89PNG') else 'image/jpeg'
+
+
+def render(source, size):
+    image = Image.open(source)
+    # a JPEG is decoded straight at a fraction of its scale
+    image.draft('RGB', (size, size))
+    image.thumbnail((size, size))
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(output, 'PNG')
+    else:
+        image.convert('RGB').save(output, 'JPEG', quality=85)
+    return output.getvalue()
+
+
+def make(digest, encoding, size):
+    path = storage.blob_path(digest) if encoding in (None, 'identity') else None
+    try:
+        if path is not None:
+            return render(path, size)
+        with storage.open_blob(digest, encoding) as stream:
+            return render(io.BytesIO(stream.read()), size)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def thumbnail(digest, encoding, filename, size=None):
+    """(size, bytes) of the thumbnail, from the cache or made now; None if the file is no image"""
+    if not is_image(filename):
+        return None
+    size = snap(size)
+    data = get_cache().get(digest, size)
+    if data is None:
+        data = make(digest, encoding, size)
+        if data is None:
+            return None
+        get_cache().put(digest, size, data)
+    return size, data
+
+
+def pregenerate(digest, encoding, filename):
+    """queues the THUMBNAIL_PREGENERATE sizes of a new upload on the thumbnail workers"""
+    sizes = app.config['THUMBNAIL_PREGENERATE']
+    if sizes and is_image(filename):
+        return get_executor().submit(generate, digest, encoding, filename, sizes)
+    return None
+
+
+def generate(digest, encoding, filename, sizes):
+    with app.app_context():
+        for size in sizes:
+            try:
+                thumbnail(digest, encoding, filename, size)
+            except Exception:
+                app.logger.exception('thumbnail %s of %s failed', size, digest)
@@ -1,26 +1,114 @@
+import time
 import datetime
+import threading
+from collections import OrderedDict, namedtuple
 from functools import wraps
 import jwt
-from flask import request, make_response
+from flask import request, make_response, send_file, Response, g
 from flask_jsonrpc import jsonify, JSONRPC
-from werkzeug.security import check_password_hash
-from api import app
-from .models import File, Folder, User, PublicLinks
+from flask_jsonrpc.exceptions import Error
+from sqlalchemy import event, inspect
+from api import app, tasks, metrics, security, thumbnails, counters, checksums
+from .models import File, Folder, User, PublicLinks, UploadSession, UploadReceipt
 
 
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        if 'x-access-token' in request.headers:
-            token = request.headers['x-access-token']
-        if not token:
-            return {'message': 'Token is missing!'}
+CachedUser = namedtuple('CachedUser', ['id', 'name', 'admin'])
+
+
+class TokenCache(object):
+    """LRU of already verified tokens and the users they belong to.
+
+    an entry lives until the token expires or TOKEN_CACHE_TTL seconds pass,
+    whichever comes first, and is dropped as soon as its user is changed
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None and entry[1] > time.time():
+                self.entries.move_to_end(token)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token, user, expire):
+        with self.lock:
+            self.entries[token] = (CachedUser(user.id, user.name, user.admin), min(expire, time.time() + self.ttl))
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, name):
+        with self.lock:
+            for token in [token for token, entry in self.entries.items() if entry[0].name == name]:
+                del self.entries[token]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_user(mapper, connection, user):
+    # a renamed user is cached under the old name
+    for name in {user.name, *inspect(user).attrs.name.history.deleted}:
+        token_cache.invalidate(name)
+
+
+def authenticate():
+    """(user, None) for the x-access-token of the request, or (None, the error message)"""
+    token = None
+    if 'x-access-token' in request.headers:
+        token = request.headers['x-access-token']
+    if not token:
+        return None, {'message': 'Token is missing!'}
+    current_user = token_cache.get(token)
+    if current_user is None:
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'])
             current_user = User.query.filter_by(name=data['name']).first()
         except:
-            return {'message': 'token is invalid!'}
+            return None, {'message': 'token is invalid!'}
+        if current_user is not None:
+            token_cache.put(token, current_user, data['exp'])
+    return current_user, None
+
+
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        current_user, error = authenticate()
+        if error is not None:
+            return error
+        return f(current_user, *args, **kwargs)
+    return decorated
+
+
+def http_token_required(f):
+    """token_required for plain HTTP routes, where an error has to be a 401 and not a body"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        current_user, error = authenticate()
+        if error is not None:
+            return error, 401
         return f(current_user, *args, **kwargs)
     return decorated
 
@@ -28,66 +116,262 @@ def token_required(f):
 jsonrpc = JSONRPC(app)
 
 
-@jsonrpc.method('View.user')
+def rpc_method(name):
+    """jsonrpc.method with latency, sql and transfer metrics around every call"""
+    def decorator(f):
+        return jsonrpc.method(name)(metrics.instrument(name, f))
+    return decorator
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    lines = metrics.registry.render()
+    for name, value in [('filebox_token_cache_hits_total', token_cache.hits),
+                        ('filebox_token_cache_misses_total', token_cache.misses)]:
+        lines += [f'# TYPE {name} counter', f'{name} {value}']
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+tasks.schedule('link-sweeper', app.config['LINK_SWEEP_INTERVAL'], PublicLinks.sweep_expired)
+tasks.schedule('folder-reaper', app.config['FOLDER_REAP_INTERVAL'], Folder.reap_deleted)
+tasks.schedule('receipt-sweeper', app.config['RECEIPT_SWEEP_INTERVAL'], UploadReceipt.sweep_expired)
+tasks.schedule('upload-session-sweeper', app.config['UPLOAD_SESSION_SWEEP_INTERVAL'], UploadSession.sweep_expired)
+tasks.schedule('download-counter', app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'], counters.downloads.flush, at_stop=True)
+
+
+@rpc_method('View.user')
 @token_required
-def user_folders(current_user, path):
-    return Folder.user_folders(path=path, owner_id=current_user.id)
+def user_folders(current_user, path, limit=None, cursor=None, sort='name', order='asc', fields=None):
+    return Folder.user_folders(path=path, owner_id=current_user.id, limit=limit, cursor=cursor,
+                               sort=sort, order=order, fields=fields)
 
 
-@jsonrpc.method('Create.folder')
+@rpc_method('View.tree')
+@token_required
+def user_tree(current_user, path):
+    return Folder.user_tree(path=path, owner_id=current_user.id)
+
+
+@rpc_method('View.usage')
+@token_required
+def usage(current_user, path=None):
+    return User.usage(owner_id=current_user.id, path=path)
+
+
+@rpc_method('Search.files')
+@token_required
+def search_files(current_user, query=None, path=None, prefix=False, in_path=False, min_size=None, max_size=None,
+                 after=None, before=None, limit=None, cursor=None):
+    return File.search(owner_id=current_user.id, query=query, path=path, prefix=prefix, in_path=in_path,
+                       min_size=min_size, max_size=max_size, after=after, before=before, limit=limit, cursor=cursor)
+
+
+@rpc_method('Create.folder')
 @token_required
 def create_folder(current_user, name, path):
     return Folder.create_folder(name=name, path=path, owner_id = current_user.id)
 
 
-@jsonrpc.method('Upload.file')
+@rpc_method('Move.folder')
+@token_required
+def move_folder(current_user, path, newpath, name=None):
+    return Folder.move_folder(path=path, newpath=newpath, name=name, owner_id=current_user.id)
+
+
+@rpc_method('Delete.folder')
 @token_required
-def upload_file(current_user, path, encoded_file, filename):
+def delete_folder(current_user, path):
+    return Folder.delete_folder(path=path, owner_id=current_user.id)
+
+
+@rpc_method('Upload.file')
+@token_required
+def upload_file(current_user, path, filename, encoded_file=None, sha256=None, crc32c=None, idempotency_key=None):
+    if idempotency_key is not None:
+        if len(idempotency_key) > 128:
+            return {"message": "idempotency key is too long"}
+        # a retry of an upload that went through gets the same answer, without the bytes
+        receipt = UploadReceipt.find(current_user.id, idempotency_key)
+        if receipt is not None:
+            return receipt
+    if encoded_file is None:
+        return {"message": "file is missing"}
+    if crc32c is not None and not checksums.has_crc32c():
+        return {"message": "crc32c is not supported, send sha256"}
     folder = Folder.query.filter_by(path=path, owner_id=current_user.id).first()
     if folder is None:
         return {"message": "folder has not found"}
     file = File()
-    return file.upload_file(encoded_file=encoded_file, filename=filename,
-                            owner_id=current_user.id, folder=folder)
+    return file.upload_file(encoded_file=encoded_file, filename=filename, owner_id=current_user.id,
+                            folder=folder, sha256=sha256, crc32c=crc32c, idempotency_key=idempotency_key)
+
+
+@rpc_method('Upload.begin')
+@token_required
+def begin_upload(current_user, path, filename, size=None):
+    folder = Folder.query.filter_by(path=path, owner_id=current_user.id).first()
+    if folder is None:
+        return {"message": "folder has not found"}
+    session = UploadSession()
+    return session.begin(filename=filename, owner_id=current_user.id, folder=folder, size=size)
+
+
+@rpc_method('Upload.chunk')
+@token_required
+def upload_chunk(current_user, session, offset, encoded_chunk):
+    return UploadSession.append_chunk(session_id=session, offset=offset,
+                                      encoded_chunk=encoded_chunk, owner_id=current_user.id)
 
 
-@jsonrpc.method('Move.file')
+@rpc_method('Upload.commit')
+@token_required
+def commit_upload(current_user, session):
+    return UploadSession.commit_upload(session_id=session, owner_id=current_user.id)
+
+
+@rpc_method('Move.file')
 @token_required
 def move_file(current_user, oldpath, newpath, filename):
     return File.move_file(oldpath=oldpath, newpath=newpath,
                           filename=filename, owner_id=current_user.id)
 
 
-@jsonrpc.method('Get.file')
+@rpc_method('Move.files')
+@token_required
+def move_files(current_user, items):
+    return File.move_files(items=items, owner_id=current_user.id)
+
+
+@rpc_method('Copy.file')
+@token_required
+def copy_file(current_user, oldpath, newpath, filename):
+    return File.copy_file(oldpath=oldpath, newpath=newpath,
+                          filename=filename, owner_id=current_user.id)
+
+
+@rpc_method('Get.file')
 @token_required
 def download_file(current_user, path, filename):
     return File.download_file(path=path, filename=filename, owner_id=current_user.id)
 
 
-@jsonrpc.method('Delete.file')
+@app.route('/download/<path:path>', methods=['GET', 'HEAD'])
+@http_token_required
+def stream_file(current_user, path):
+    folder_path, _, filename = path.rpartition('/')
+    file = File.find_file(path=folder_path, filename=filename, owner_id=current_user.id)
+    if file is None:
+        return {"message": "file is not available"}, 404
+    return send_blob(file)
+
+
+@rpc_method('Get.thumbnail')
+@token_required
+def download_thumbnail(current_user, path, filename, size=None):
+    return File.download_thumbnail(path=path, filename=filename, owner_id=current_user.id, size=size)
+
+
+@app.route('/thumbnail/<path:path>', methods=['GET', 'HEAD'])
+@http_token_required
+def stream_thumbnail(current_user, path):
+    folder_path, _, filename = path.rpartition('/')
+    file = File.find_file(path=folder_path, filename=filename, owner_id=current_user.id)
+    found = None
+    if file is not None:
+        found = thumbnails.thumbnail(file.blob_hash, file.blob.encoding, file.public_name, request.args.get('size'))
+    if found is None:
+        return {"message": "thumbnail is not available"}, 404
+    size, data = found
+    response = Response(data, mimetype=thumbnails.mimetype(data))
+    response.set_etag(f'{file.blob_hash}-{size}')
+    response.cache_control.private = True
+    response.cache_control.max_age = 24*60*60
+    return response.make_conditional(request)
+
+
+@app.route('/public/<path:link>', methods=['GET', 'HEAD'])
+def public_file(link):
+    file = PublicLinks.resolve(link)
+    if file is None:
+        return {"message": "link is not available"}, 404
+    return send_blob(file)
+
+
+def send_blob(file):
+    response = send_file(file.real_path or file.open(), as_attachment=True,
+                         attachment_filename=file.public_name, add_etags=False)
+    response.content_length = file.blob.size
+    response.set_etag(file.blob_hash)
+    response.make_conditional(request, accept_ranges=True, complete_length=file.blob.size)
+    # a resumed download (range past the first byte) is the same download, not a new one; a HEAD is none
+    if request.method == 'GET' and (response.status_code == 200 or
+                                    (response.status_code == 206 and request.range.ranges[0][0] == 0)):
+        file.count_download()
+    return response
+
+
+@rpc_method('Delete.file')
 @token_required
 def delete_file(current_user, path, filename):
     return File.delete_file(path=path, filename=filename, owner_id=current_user.id)
 
 
-@jsonrpc.method('Share.file')
+@rpc_method('Delete.files')
+@token_required
+def delete_files(current_user, items):
+    return File.delete_files(items=items, owner_id=current_user.id)
+
+
+@rpc_method('Share.file')
 @token_required
 def share_file(current_user, path, filename, time):
     file = PublicLinks()
     return file.share_file(path=path, filename=filename, time=time, owner_id=current_user.id)
 
 
-@jsonrpc.method('Create.user')
+@rpc_method('Share.files')
+@token_required
+def share_files(current_user, items):
+    return PublicLinks.share_files(items=items, owner_id=current_user.id)
+
+
+class PasswordPoolBusyError(Error):
+    """the password pool is full, answered with HTTP 503 and a Retry-After"""
+    code = 503
+    message = 'too many logins, try again later'
+    status = 503
+
+
+def password_pool_busy():
+    g.retry_after = app.config['PASSWORD_WAIT']
+    raise PasswordPoolBusyError()
+
+
+@app.after_request
+def add_retry_after(response):
+    retry_after = g.get('retry_after')
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@rpc_method('Create.user')
 def create_user(username, password):
-    return User.create_user(username, password)
+    try:
+        return User.create_user(username, password)
+    except security.PasswordPoolBusy:
+        password_pool_busy()
 
 
-@jsonrpc.method('Login.user')
+@rpc_method('Login.user')
 def login(username, password):
     user = User.query.filter_by(name=username).first()
     if not user:
         return make_response('Could not verify', 401, {'WWW-Authenticate': 'Basic realm="Login required"'})
 
-    if check_password_hash(user.password, password):
+    try:
+        verified = user.check_password(password)
+    except security.PasswordPoolBusy:
+        password_pool_busy()
+    if verified:
         token = jwt.encode({'name': user.name, 'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=120)}, app.config['SECRET_KEY'])
         return jsonify({'token': token.decode('UTF-8')})
\ No newline at end of file
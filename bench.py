@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""Load generator for the JSON-RPC api.
+
+Every worker registers its own user, then runs the request mix in a loop:
+the methods of the mix file, in file order, with parameters filled in for
+that worker. Per method it reports throughput, p50/p95/p99 latency, the calls
+that failed (a JSON-RPC error, or a message that is not a success) and the
+largest growth of the resident set across one call (in-process mode on Linux
+only; with concurrency the other workers' calls add to it).
+
+    python bench.py --concurrency 8 --iterations 50 --file-size 1048576
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --compare bench_baseline.json --tolerance 0.2
+    python bench.py --url http://localhost:5001/api
+    python bench.py --logins --concurrency 16 --iterations 20
+
+With --logins the mix is Login.user alone, and the report adds logins/sec per
+core: the password hashing cores, PASSWORD_WORKERS in-process or --cores for
+a server.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import argparse
+import tempfile
+import threading
+import urllib.request
+from collections import defaultdict
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+# messages of a successful call, e.g. "file has been uploaded", "folder is created"
+SUCCESS_MARKERS = ('has been', 'is created')
+DEFAULT_MIX = ['Upload.file', 'View.user', 'Create.folder', 'Move.file', 'Get.file', 'Share.file', 'Delete.file']
+
+
+def load_mix(path):
+    """methods and parameters from a file of JSON-RPC calls, one JSON object per line or blank-line block"""
+    calls = []
+    decoder = json.JSONDecoder()
+    with open(path) as file:
+        text = file.read()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return calls
+        call, position = decoder.raw_decode(text, position)
+        if call.get('method') not in ('Create.user', 'Login.user'):
+            calls.append(call)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def current_rss_mb():
+    """the resident set right now, None where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * PAGE_SIZE / (1024 * 1024)
+
+
+def failed(response):
+    """a JSON-RPC error, or a result with a message that is not one of success"""
+    if 'error' in response:
+        return True
+    result = response.get('result')
+    message = result.get('message') if isinstance(result, dict) else None
+    return message is not None and not any(marker in message for marker in SUCCESS_MARKERS)
+
+
+class InProcessClient(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, payload, token=None):
+        headers = {'content-type': 'application/json'}
+        if token:
+            headers['x-access-token'] = token
+        response = self.client.post('/api', data=json.dumps(payload), headers=headers)
+        return json.loads(response.data)
+
+
+class HTTPClient(object):
+
+    def __init__(self, url):
+        self.url = url
+
+    def post(self, payload, token=None):
+        headers = {'content-type': 'application/json'}
+        if token:
+            headers['x-access-token'] = token
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode(), headers=headers)
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, number, client, mix, iterations, content, stats, measure_rss):
+        super().__init__(name=f'bench-{number}')
+        self.username = f'bench{number}_{os.getpid()}_{int(time.time())}'
+        self.client = client
+        self.mix = mix
+        self.iterations = iterations
+        self.encoded_file = base64.b64encode(content).decode()
+        self.stats = stats
+        self.measure_rss = measure_rss
+        self.token = None
+
+    def params(self, method, template, iteration):
+        root = self.username
+        filename = f'file{iteration}.bin'
+        folder = f'folder{iteration}'
+        params = {
+            'View.user': {'path': root},
+            'Create.folder': {'path': root, 'name': folder},
+            'Upload.file': {'path': root, 'filename': filename, 'encoded_file': self.encoded_file},
+            'Move.file': {'oldpath': root, 'newpath': f'{root}/{folder}', 'filename': filename},
+            'Get.file': {'path': f'{root}/{folder}', 'filename': filename},
+            'Share.file': {'path': f'{root}/{folder}', 'filename': filename, 'time': '5'},
+            'Delete.file': {'path': f'{root}/{folder}', 'filename': filename},
+            'Login.user': {'username': self.username, 'password': 'bench'},
+        }.get(method)
+        if params is None:
+            params = dict(template.get('params') or {})
+            # sample files use "user" as the root folder
+            for key, value in params.items():
+                if isinstance(value, str) and (value == 'user' or value.startswith('user/')):
+                    params[key] = root + value[4:]
+        return params
+
+    def call(self, method, params):
+        payload = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': 1}
+        rss_before = current_rss_mb() if self.measure_rss else None
+        started = time.perf_counter()
+        try:
+            response = self.client.post(payload, self.token)
+            error = failed(response)
+        except Exception:
+            response, error = {}, True
+        elapsed = time.perf_counter() - started
+        rss_growth = current_rss_mb() - rss_before if rss_before is not None else 0.0
+        self.stats.record(method, elapsed, error, rss_growth)
+        return response
+
+    def run(self):
+        self.call('Create.user', {'username': self.username, 'password': 'bench'})
+        self.token = self.call('Login.user', {'username': self.username, 'password': 'bench'}).get('token')
+        for iteration in range(self.iterations):
+            for template in self.mix:
+                method = template['method']
+                self.call(method, self.params(method, template, iteration))
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rss = defaultdict(float)
+
+    def record(self, method, elapsed, failed, rss_growth):
+        with self.lock:
+            self.latencies[method].append(elapsed)
+            if failed:
+                self.errors[method] += 1
+            self.rss[method] = max(self.rss[method], rss_growth)
+
+    def report(self, wall_time):
+        report = {}
+        for method, latencies in sorted(self.latencies.items()):
+            report[method] = {
+                'count': len(latencies),
+                'errors': self.errors[method],
+                'throughput': round(len(latencies) / wall_time, 2),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                'rss_growth_mb': round(self.rss[method], 1),
+            }
+        return report
+
+
+def compare(report, baseline, tolerance):
+    """methods whose p95 grew or throughput dropped by more than tolerance"""
+    regressions = []
+    for method, current in report.items():
+        previous = baseline.get(method)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{method}: p95 {previous["p95_ms"]}ms -> {current["p95_ms"]}ms')
+        if current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f'{method}: throughput {previous["throughput"]}/s -> {current["throughput"]}/s')
+    return regressions
+
+
+def prepare_app(workdir):
+    """the app on a scratch database and storage folder"""
+    from api import app, db, storage, views
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'storage')
+    storage.set_backend(None)
+    db.create_all()
+    return app
+
+
+def print_report(report):
+    columns = ['count', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'rss_growth_mb']
+    print(f'{"method":<16}' + ''.join(f'{column:>14}' for column in columns))
+    for method, row in report.items():
+        print(f'{method:<16}' + ''.join(f'{row[column]:>14}' for column in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', help='file of JSON-RPC calls to replay, e.g. test_requests.json')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=64*1024)
+    parser.add_argument('--url', help='api url of a running server, default is in-process')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--logins', action='store_true', help='measure Login.user alone')
+    parser.add_argument('--cores', type=int, help='password hashing cores of the server at --url')
+    args = parser.parse_args(argv)
+
+    mix = load_mix(args.mix) if args.mix else [{'method': method} for method in DEFAULT_MIX]
+    if args.logins:
+        mix = [{'method': 'Login.user'}]
+    workdir = None
+    cores = args.cores or os.cpu_count()
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)
+    else:
+        workdir = tempfile.mkdtemp(prefix='filebox-bench-')
+        app = prepare_app(workdir)
+        cores = app.config['PASSWORD_WORKERS']
+        make_client = lambda: InProcessClient(app)
+    content = os.urandom(args.file_size)
+    stats = Stats()
+    workers = [Worker(number, make_client(), mix, args.iterations, content, stats, args.url is None)
+               for number in range(args.concurrency)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    report = stats.report(time.perf_counter() - started)
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.logins:
+        print(f'logins/sec per core: {report["Login.user"]["throughput"] / cores:.2f} ({cores} cores)')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,63 @@ import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 SECRET_KEY = 'thisissecret'
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300  # seconds
+PASSWORD_HASH = 'scrypt'  # scrypt, or argon2 (needs the argon2-cffi package)
+SCRYPT_N = 2**15
+SCRYPT_R = 8
+SCRYPT_P = 1
+ARGON2_TIME_COST = 3
+ARGON2_MEMORY_COST = 64*1024  # KiB
+ARGON2_PARALLELISM = 1
+PASSWORD_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # processes for hashing, the rest of the cores serve files
+PASSWORD_QUEUE = 64  # logins waiting for a worker before the next one is refused
+PASSWORD_WAIT = 5  # seconds a login waits for a place in the queue
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'app.db'))
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30  # seconds
+DB_POOL_RECYCLE = 1800  # seconds
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_BUSY_TIMEOUT = 5000  # milliseconds
 MAX_CONTENT_LENGTH = 64*1024*1024
-UPLOAD_FOLDER = os.path.join(basedir, 'storage')
\ No newline at end of file
+UPLOAD_CHUNK_SIZE = 8*1024*1024
+MAX_PAGE_SIZE = 1000
+SEARCH_PAGE_SIZE = 100
+DEFAULT_QUOTA = None  # bytes per user, None for no limit
+MAX_BATCH_SIZE = 5000
+LINK_SWEEP_INTERVAL = 60  # seconds
+LINK_SWEEP_BATCH = 1000
+DOWNLOAD_COUNT_FLUSH_INTERVAL = 5  # seconds between writes of the download counts
+FOLDER_REAP_INTERVAL = 30  # seconds
+FOLDER_REAP_BATCH = 1000
+IDEMPOTENCY_KEY_TTL = 24*60*60  # seconds an Upload.file answer is kept for retries
+RECEIPT_SWEEP_INTERVAL = 60*60  # seconds
+UPLOAD_SESSION_TTL = 24*60*60  # seconds an unfinished chunked upload is kept since its last chunk
+UPLOAD_SESSION_SWEEP_INTERVAL = 60*60  # seconds
+FSCK_GRACE = 60*60  # seconds an object without a blob row is left alone by fsck, it may be in flight
+ASGI_WORKER_THREADS = 32
+ASGI_SPOOL_SIZE = 1024*1024
+ASGI_BLOCK_SIZE = 256*1024
+UPLOAD_FOLDER = os.path.join(basedir, 'storage')
+STORAGE_COMPRESSION = None  # None, gzip or zstd (needs the zstandard package)
+STORAGE_COMPRESSION_LEVEL = 6
+COMPRESSION_MAX_ENTROPY = 7.0  # bits per byte, content above it is stored as is
+STORAGE_BACKEND = 'local'  # local, memory or s3
+S3_BUCKET = 'filebox'
+S3_ENDPOINT_URL = None  # e.g. http://localhost:9000 for MinIO
+S3_REGION = None
+S3_MAX_POOL_CONNECTIONS = 32
+S3_MULTIPART_THRESHOLD = 8*1024*1024
+S3_MULTIPART_CHUNKSIZE = 8*1024*1024
+
+THUMBNAIL_FOLDER = os.path.join(basedir, 'thumbnails')
+THUMBNAIL_CACHE_SIZE = 256*1024*1024
+THUMBNAIL_SIZES = (64, 128, 256, 512)  # pixels, the longer side
+THUMBNAIL_DEFAULT_SIZE = 256
+THUMBNAIL_PREGENERATE = ()  # sizes made right after an upload, e.g. (128, 256)
+THUMBNAIL_WORKERS = 2
+
+PROFILE_SAMPLE_RATE = 0.0  # share of rpc calls run under cProfile
+PROFILE_FOLDER = os.path.join(basedir, 'profiles')
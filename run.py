@@ -1,3 +1,14 @@
 #!/usr/bin/env python
-from api import app
-app.run(debug=True, port=5001)
\ No newline at end of file
+import os
+import sys
+from api import app, views, tasks
+
+if __name__ == '__main__':
+    if '--asgi' in sys.argv:
+        import uvicorn
+        uvicorn.run('api.asgi:application', port=5001)
+    else:
+        # the reloader runs the app in a child process, the tasks belong there and not in the watcher too
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            tasks.start()
+        app.run(debug=True, port=5001)
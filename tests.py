@@ -1,12 +1,21 @@
 #!/usr/bin/env python
+import io
+import datetime
 import os
 import unittest
 from config import basedir
 import json
 import base64
+import hashlib
+import asyncio
+import tempfile
+import importlib.util
+from unittest import mock
 
 
-from api import app, db
+from api import app, db, views, storage, asgi, migrations, checksums, security, thumbnails, counters, fsck, search, tasks
+from api.models import Blob, User, PublicLinks, File, Folder, UploadSession
+from werkzeug.security import generate_password_hash
 
 
 TEST_DB = 'test.db'
@@ -18,7 +27,10 @@ class Tests(unittest.TestCase):
     def setUp(self):
         print('---------------------- RUNNING setUp')
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, TEST_DB)
+        app.config['SCRYPT_N'] = 2**10  # a cheap KDF, the cost is not under test
         self.app = app.test_client()
+        views.token_cache.clear()
+        counters.downloads.clear()
         db.drop_all()
         db.create_all()
 
@@ -61,6 +73,38 @@ class Tests(unittest.TestCase):
             "id": "1"}
         return self.app.post('/api', data=json.dumps(data), headers={'content-type': 'application/json', 'x-access-token': token})
 
+    def call(self, token, method, **params):
+        data = {"jsonrpc": "2.0", "method": method, "params": params, "id": "1"}
+        response = self.app.post('/api', data=json.dumps(data),
+                                 headers={'content-type': 'application/json', 'x-access-token': token})
+        return json.loads(response.data)['result']
+
+    def deleted_meanwhile(self, method='first'):
+        """patches Query.<method> so the file rows it loads are deleted by another connection right after"""
+        query_class = type(File.query)
+        load = getattr(query_class, method)
+
+        def racing(query):
+            result = load(query)
+            if query.column_descriptions[0]['entity'] is not File:
+                return result
+            if method == '__iter__':
+                result = list(result)
+            ids = [row.id for row in (result if isinstance(result, list) else [result]) if row is not None]
+            if ids:
+                db.engine.execute(File.__table__.delete().where(File.__table__.c.id.in_(ids)))
+            return iter(result) if method == '__iter__' else result
+        return mock.patch.object(query_class, method, racing)
+
+    def upload_chunked(self, token, filename, chunk_size=100000):
+        with open(file_dir, 'rb') as image_file:
+            content = image_file.read()
+        session = self.call(token, 'Upload.begin', path='vasya', filename=filename)['session']
+        for offset in range(0, len(content), chunk_size):
+            chunk = base64.b64encode(content[offset:offset + chunk_size]).decode()
+            self.call(token, 'Upload.chunk', session=session, offset=offset, encoded_chunk=chunk)
+        return self.call(token, 'Upload.commit', session=session)
+
     def make_folder(self, token, folder_name='folder1'):
 
         data = {
@@ -88,6 +132,77 @@ class Tests(unittest.TestCase):
         self.assertEqual(json.loads(response1.data)['result'],  {"message": "user has been created with default folder"})
         self.assertEqual(json.loads(response2.data)['result'], {'message': 'username is already exists. please choose another username'})
 
+    def test_legacy_password_is_rehashed_on_login(self):
+        self.create_user(username='vasya', password='pupkin')
+        user = User.query.filter_by(name='vasya').first()
+        user.password = generate_password_hash('pupkin', method='sha256')
+        db.session.commit()
+        self.assertIn('token', json.loads(self.login_user(username='vasya', password='pupkin').data))
+        db.session.expire_all()
+        self.assertTrue(User.query.filter_by(name='vasya').first().password.startswith('scrypt:1024:8:1$'))
+        self.assertIn('token', json.loads(self.login_user(username='vasya', password='pupkin').data))
+        self.assertIsNone(json.loads(self.login_user(username='vasya', password='wrong').data).get('token'))
+
+    def test_password_pool_is_bounded(self):
+        pool = security.PasswordPool(workers=1, queue=0, wait=0)
+        pool.slots.acquire()
+        with self.assertRaises(security.PasswordPoolBusy):
+            pool.run(security.verify, 'scrypt:1024:8:1$salt$00', 'password')
+
+    def test_busy_password_pool(self):
+        self.create_user(username='vasya', password='pupkin')
+        user = User.query.filter_by(name='vasya').first()
+        user.password = stored = security.make_hash('pupkin', 'scrypt', (2**11, 8, 1))
+        db.session.commit()
+
+        def run(func, *args):
+            # verifying gets through, the pool is full again by the time of any hashing
+            if func is security.make_hash:
+                raise security.PasswordPoolBusy()
+            return func(*args)
+        with mock.patch.object(security.pool, 'run', run):
+            self.assertIn('token', json.loads(self.login_user(username='vasya', password='pupkin').data))
+            response = self.create_user(username='petya', password='pupkin')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], str(app.config['PASSWORD_WAIT']))
+        self.assertEqual(json.loads(response.data)['error']['code'], 503)
+        db.session.expire_all()
+        self.assertEqual(User.query.filter_by(name='vasya').first().password, stored)
+
+    def test_password_pool_survives_a_dead_worker(self):
+        pool = security.PasswordPool(workers=1, queue=0, wait=1)
+        self.addCleanup(pool.shutdown)
+        stored = security.make_hash('password', 'scrypt', (2**10, 8, 1))
+        self.assertTrue(pool.run(security.verify, stored, 'password'))
+        for process in list(pool.executor._processes.values()):
+            process.kill()
+            process.join()
+        self.assertTrue(pool.run(security.verify, stored, 'password'))
+
+    def test_token_cache(self):
+        token = self.get_token()
+        misses = views.token_cache.misses
+        self.make_folder(token, folder_name='folder1')
+        hits = views.token_cache.hits
+        self.make_folder(token, folder_name='folder2')
+        self.assertEqual(views.token_cache.hits, hits + 1)
+        self.assertEqual(views.token_cache.misses, misses + 1)
+        user = User.query.filter_by(name='vasya').first()
+        user.admin = True
+        db.session.commit()
+        self.assertIsNone(views.token_cache.get(token))
+
+    def test_metrics(self):
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        self.call(token, 'View.user', path='vasya')
+        body = self.app.get('/metrics').data.decode()
+        self.assertIn('filebox_rpc_latency_seconds_count{method="View.user"}', body)
+        self.assertIn('filebox_rpc_sql_queries_bucket{method="Upload.file",le="+Inf"}', body)
+        received = [line for line in body.splitlines()
+                    if line.startswith('filebox_http_received_bytes_total{endpoint="Upload.file"}')]
+        self.assertGreater(int(received[0].split()[-1]), os.path.getsize(file_dir))
+
     def test_create_folder(self):
         token = self.get_token()
         response = self.make_folder(token=token)
@@ -117,6 +232,42 @@ class Tests(unittest.TestCase):
 
         self.assertEqual(json.loads(response.data)['result'], {"message": "you choose wrong folder path"})
 
+    def test_view_user_pages(self):
+        token = self.get_token()
+        for filename in ['c.png', 'a.png', 'b.png']:
+            self.upload(token=token, filename=filename)
+        self.call(token, 'Get.file', path='vasya', filename='b.png')
+        counters.downloads.flush()
+        first = self.call(token, 'View.user', path='vasya', limit=2)
+        self.assertEqual(first['files'], [{'name': 'a.png'}, {'name': 'b.png'}])
+        self.assertEqual(first['folders_in'], [])
+        second = self.call(token, 'View.user', path='vasya', limit=2, cursor=first['next_cursor'])
+        self.assertEqual(second['files'], [{'name': 'c.png'}])
+        self.assertIsNone(second['next_cursor'])
+        by_downloads = self.call(token, 'View.user', path='vasya', limit=1, sort='download_count',
+                                 order='desc', fields=['name', 'size', 'download_count'])
+        self.assertEqual(by_downloads['files'], [{'name': 'b.png', 'size': os.path.getsize(file_dir),
+                                                  'download_count': 1}])
+        self.assertEqual(self.call(token, 'View.user', path='vasya', limit='abc'), {"message": "limit is invalid"})
+        # a legacy file the migration left without content
+        home = Folder.query.filter_by(path='vasya').one()
+        db.session.add(File(public_name='legacy.txt', folder_id=home.id, owner_id=home.owner_id))
+        db.session.commit()
+        by_size = self.call(token, 'View.user', path='vasya', limit=2, sort='size', fields=['name', 'size'])
+        self.assertEqual(by_size['files'], [{'name': 'legacy.txt', 'size': 0}, {'name': 'c.png', 'size': os.path.getsize(file_dir)}])
+
+    def test_view_tree(self):
+        token = self.get_token()
+        self.make_folder(token, folder_name='folder1')
+        self.make_folder(token, folder_name='folder1 copy')
+        self.call(token, 'Create.folder', path='vasya/folder1', name='inner')
+        self.upload(token=token, filename='default.png')
+        self.call(token, 'Move.file', oldpath='vasya', newpath='vasya/folder1/inner', filename='default.png')
+        response = self.call(token, 'View.tree', path='vasya/folder1')
+        self.assertEqual(response['folders'], ['vasya/folder1/inner'])
+        self.assertEqual(response['files'], ['vasya/folder1/inner/default.png'])
+        self.assertEqual(response['size'], os.path.getsize(file_dir))
+
     def test_upload_file(self):
         token = self.get_token()
         filename = 'default.png'
@@ -130,6 +281,168 @@ class Tests(unittest.TestCase):
         response = self.upload(token=token, filename=filename)
         self.assertEqual(json.loads(response.data)['result'], {"message": "file already exists"})
 
+    def test_upload_with_checksums_and_idempotency_key(self):
+        token = self.get_token()
+        with open(file_dir, 'rb') as image_file:
+            content = image_file.read()
+        encoded = base64.b64encode(content).decode()
+        response = self.call(token, 'Upload.file', path='vasya', filename='default.png', encoded_file=encoded,
+                             sha256='0' * 64)
+        self.assertEqual(response['message'], 'checksum mismatch')
+        self.assertEqual(Blob.query.count(), 0)
+        params = dict(path='vasya', filename='default.png', idempotency_key='upload-1',
+                      sha256=hashlib.sha256(content).hexdigest())
+        response = self.call(token, 'Upload.file', encoded_file=encoded, **params)
+        self.assertEqual(response, {"file": "default.png", "message": "file has been uploaded"})
+        self.assertEqual(self.call(token, 'Upload.file', **params), response)
+        self.assertEqual(File.query.count(), 1)
+
+    def test_blob_is_stored_on_commit(self):
+        temp, digest, size = storage.write_temp(b'rolled back')
+        Blob.acquire(temp, digest, size)
+        db.session.rollback()
+        self.assertFalse(storage.exists(digest))
+        self.assertFalse(os.path.exists(temp))
+        temp, digest, size = storage.write_temp(b'committed')
+        Blob.acquire(temp, digest, size)
+        self.assertFalse(storage.exists(digest))
+        db.session.commit()
+        self.assertEqual(storage.read_blob(digest), b'committed')
+
+    def test_fsck(self):
+        token = self.get_token()
+        for filename in ['a.txt', 'b.txt', 'c.txt']:
+            self.call(token, 'Upload.file', path='vasya', filename=filename,
+                      encoded_file=base64.b64encode(filename.encode() * 60).decode())
+        self.assertEqual(fsck.check(), dict({kind: [] for kind in fsck.PROBLEMS}, fixed=0))
+        # deleted but not yet reaped, no longer charged
+        self.make_folder(token)
+        self.call(token, 'Copy.file', oldpath='vasya', newpath='vasya/folder1', filename='c.txt')
+        self.call(token, 'Delete.folder', path='vasya/folder1')
+        temp, orphan, _ = storage.write_temp(b'orphan')
+        storage.put(temp, orphan)
+        os.utime(storage.blob_path(orphan), (0, 0))
+        home = Folder.query.filter_by(path='vasya').one()
+        a, b, c = (File.query.filter_by(public_name=name, folder_id=home.id).one() for name in ['a.txt', 'b.txt', 'c.txt'])
+        storage.remove(a.blob_hash)
+        b.blob.refcount = 5
+        c.size = 1
+        db.session.commit()
+        report = fsck.check(workers=2)
+        self.assertEqual(report['orphaned'], [(orphan, 6)])
+        self.assertEqual(report['missing'], [(a.blob_hash,)])
+        self.assertEqual(report['refcount'], [(b.blob_hash, 5, 1)])
+        self.assertEqual(report['file_size'], [(c.id, 1, 300)])
+        self.assertEqual(fsck.check(fix=True)['fixed'], 3)
+        self.assertFalse(storage.exists(orphan))
+        db.session.expire_all()
+        self.assertEqual((b.blob.refcount, c.size), (1, 300))
+        self.assertEqual(User.query.one().used_bytes, 900)
+        report = fsck.check()
+        self.assertEqual([kind for kind in fsck.PROBLEMS if report[kind]], ['missing'])
+
+    @unittest.skipUnless(checksums.has_crc32c(), 'needs the crc32c package')
+    def test_crc32c(self):
+        self.assertEqual(checksums.crc32c(b'123456789'), 0xE3069283)
+
+    def test_blob_acquired_by_two_uploads_at_once(self):
+        temp, digest, size = storage.write_temp(b'same content')
+        update = type(Blob.query).update
+
+        def racing_update(query, values, **kwargs):
+            # the other upload inserts its row right after this one found none
+            if not racing_update.raced:
+                racing_update.raced = True
+                db.engine.execute(Blob.__table__.insert().values(hash=digest, size=size, stored_size=size,
+                                                                 encoding='identity', refcount=1))
+                return 0
+            return update(query, values, **kwargs)
+        racing_update.raced = False
+        with mock.patch.object(type(Blob.query), 'update', racing_update):
+            blob = Blob.acquire(temp, digest, size)
+        db.session.commit()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(Blob.query.count(), 1)
+        self.assertFalse(os.path.exists(temp))
+        self.assertFalse(storage.exists(digest))
+
+    def test_blob_collected_while_acquired(self):
+        temp, digest, size = storage.write_temp(b'same content')
+        blob = Blob.acquire(temp, digest, size)
+        db.session.commit()
+        Blob.release(digest)
+        db.session.commit()
+        update = type(Blob.query).update
+
+        def collected_update(query, values, **kwargs):
+            # a collect deletes the released row just before this upload references it
+            if not collected_update.raced:
+                collected_update.raced = True
+                db.engine.execute(Blob.__table__.delete().where(Blob.__table__.c.hash == digest))
+            return update(query, values, **kwargs)
+        collected_update.raced = False
+        temp, _, _ = storage.write_temp(b'same content')
+        with mock.patch.object(type(Blob.query), 'update', collected_update):
+            blob = Blob.acquire(temp, digest, size)
+        db.session.commit()
+        self.assertEqual(blob.refcount, 1)
+        self.assertFalse(os.path.exists(temp))
+        self.assertEqual(storage.read_blob(digest), b'same content')
+
+    def test_collect_keeps_a_blob_stored_again(self):
+        temp, digest, size = storage.write_temp(b'same content')
+        Blob.acquire(temp, digest, size)
+        db.session.commit()
+        Blob.release(digest)
+        db.session.commit()
+        commit = db.session.commit
+
+        def uploaded_meanwhile():
+            # an upload of the same content inserts its row again right after the delete is committed
+            commit()
+            db.engine.execute(Blob.__table__.insert().values(hash=digest, size=size, stored_size=size,
+                                                             encoding='identity', refcount=1))
+        with mock.patch.object(db.session, 'commit', uploaded_meanwhile):
+            Blob.collect(digest)
+        self.assertTrue(storage.exists(digest))
+
+    def test_crc32c_needs_the_package(self):
+        token = self.get_token()
+        with mock.patch.object(checksums, '_crc32c', None):
+            response = self.call(token, 'Upload.file', path='vasya', filename='a.txt',
+                                 encoded_file=base64.b64encode(b'123456789').decode(), crc32c='e3069283')
+        self.assertEqual(response, {"message": "crc32c is not supported, send sha256"})
+        self.assertEqual(File.query.count(), 0)
+
+    def test_upload_file_in_chunks(self):
+        token = self.get_token()
+        filename = 'default.png'
+        response = self.upload_chunked(token=token, filename=filename)
+        self.assertEqual(response, {"file": filename, "message": "file has been uploaded"})
+        downloaded = self.call(token, 'Get.file', path='vasya', filename=filename)['file']
+        with open(file_dir, 'rb') as image_file:
+            self.assertEqual(base64.b64decode(downloaded), image_file.read())
+
+    def test_upload_chunk_with_wrong_offset(self):
+        token = self.get_token()
+        session = self.call(token, 'Upload.begin', path='vasya', filename='default.png')['session']
+        chunk = base64.b64encode(b'12345').decode()
+        self.call(token, 'Upload.chunk', session=session, offset=0, encoded_chunk=chunk)
+        response = self.call(token, 'Upload.chunk', session=session, offset=10, encoded_chunk=chunk)
+        self.assertEqual(response, {"message": "wrong offset", "offset": 5})
+
+    def test_abandoned_upload_session_expires(self):
+        token = self.get_token()
+        stale = self.call(token, 'Upload.begin', path='vasya', filename='a.png')['session']
+        fresh = self.call(token, 'Upload.begin', path='vasya', filename='b.png')['session']
+        session = UploadSession.query.get(stale)
+        session.timestamp -= datetime.timedelta(seconds=app.config['UPLOAD_SESSION_TTL'] + 1)
+        temp_path = session.temp_path
+        db.session.commit()
+        self.assertEqual(UploadSession.sweep_expired(), 1)
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertEqual([session.id for session in UploadSession.query], [fresh])
+
     def test_delete_file(self):
         token = self.get_token()
         filename = 'default.png'
@@ -142,6 +455,62 @@ class Tests(unittest.TestCase):
                                  headers={'content-type': 'application/json', 'x-access-token': token})
         self.assertEqual(json.loads(response.data)['result'], {"file": filename, "message": "has been deleted"})
 
+    def test_same_content_is_stored_once(self):
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        self.upload(token=token, filename='copy.png')
+        digest = Blob.query.one().hash
+        self.assertEqual(Blob.query.get(digest).refcount, 2)
+        self.call(token, 'Delete.file', path='vasya', filename='default.png')
+        self.assertTrue(storage.exists(digest))
+        self.call(token, 'Delete.file', path='vasya', filename='copy.png')
+        self.assertIsNone(Blob.query.get(digest))
+        self.assertFalse(storage.exists(digest))
+
+    def test_compressed_storage(self):
+        app.config['STORAGE_COMPRESSION'] = 'gzip'
+        self.addCleanup(app.config.__setitem__, 'STORAGE_COMPRESSION', None)
+        token = self.get_token()
+        content = json.dumps([{"id": i, "name": f"row {i}"} for i in range(5000)]).encode()
+        self.call(token, 'Upload.file', path='vasya', filename='rows.json',
+                  encoded_file=base64.b64encode(content).decode())
+        self.upload(token=token, filename='default.png')
+        encodings = {blob.encoding for blob in Blob.query}
+        self.assertEqual(encodings, {'gzip', 'identity'})
+        json_blob = Blob.query.filter_by(encoding='gzip').one()
+        self.assertEqual(json_blob.size, len(content))
+        self.assertLess(json_blob.stored_size, len(content) / 5)
+        downloaded = self.call(token, 'Get.file', path='vasya', filename='rows.json')['file']
+        self.assertEqual(base64.b64decode(downloaded), content)
+        partial = self.app.get('/download/vasya/rows.json',
+                               headers={'x-access-token': token, 'Range': 'bytes=1000-1999'})
+        self.assertEqual(partial.data, content[1000:2000])
+
+    def test_usage(self):
+        token = self.get_token()
+        size = os.path.getsize(file_dir)
+        self.make_folder(token)
+        self.upload(token=token, filename='a.png')
+        self.upload(token=token, filename='b.png')
+        self.call(token, 'Move.file', oldpath='vasya', newpath='vasya/folder1', filename='a.png')
+        self.assertEqual(self.call(token, 'View.usage'), {"used": 2 * size, "quota": None})
+        self.assertEqual(self.call(token, 'View.usage', path='vasya/folder1')['used'], size)
+        self.call(token, 'Delete.files', items=[{"path": "vasya/folder1", "filename": "a.png"}])
+        self.assertEqual(self.call(token, 'View.usage', path='vasya/folder1')['used'], 0)
+        self.assertEqual(self.call(token, 'View.usage', path='vasya')['used'], size)
+
+    def test_quota(self):
+        token = self.get_token()
+        user = User.query.filter_by(name='vasya').first()
+        user.quota = os.path.getsize(file_dir) + 10
+        db.session.commit()
+        self.upload(token=token, filename='a.png')
+        response = self.upload(token=token, filename='b.png')
+        self.assertEqual(json.loads(response.data)['result'], {"message": "quota exceeded"})
+        response = self.call(token, 'Upload.begin', path='vasya', filename='c.png', size=11)
+        self.assertEqual(response, {"message": "quota exceeded"})
+        self.assertEqual(File.query.count(), 1)
+
     def test_delete_ghost_file(self):
         token = self.get_token()
         data = {"jsonrpc": "2.0",
@@ -152,6 +521,17 @@ class Tests(unittest.TestCase):
                                  headers={'content-type': 'application/json', 'x-access-token': token})
         self.assertEqual(json.loads(response.data)['result'], {"message": "file has not found"})
 
+    def test_delete_file_twice_at_once(self):
+        token = self.get_token()
+        for filename in ['a.png', 'b.png']:
+            self.upload(token=token, filename=filename)
+        with self.deleted_meanwhile():
+            response = self.call(token, 'Delete.file', path='vasya', filename='a.png')
+        self.assertEqual(response, {"message": "file has not found"})
+        # the delete that won released its share, this one took nothing more
+        self.assertEqual(Blob.query.one().refcount, 2)
+        self.assertEqual(self.call(token, 'View.usage')['used'], 2 * os.path.getsize(file_dir))
+
     def test_delete_file_from_wrong_directory(self):
         token = self.get_token()
         filename = 'default.png'
@@ -217,6 +597,155 @@ class Tests(unittest.TestCase):
                                  headers={'content-type': 'application/json', 'x-access-token': token})
         self.assertEqual(json.loads(response.data)['result'], {"message": "file is not available"})
 
+    def test_search_files(self):
+        token = self.get_token()
+        self.make_folder(token, 'photos')
+        for filename in ('holiday.png', 'Holiday_2.png', 'notes.png'):
+            self.upload(token=token, filename=filename)
+        self.call(token, 'Move.file', oldpath='vasya', newpath='vasya/photos', filename='holiday.png')
+        names = lambda result: [(row['path'], row['name']) for row in result['files']]
+        self.assertEqual(names(self.call(token, 'Search.files', query='liday')),
+                         [('vasya', 'Holiday_2.png'), ('vasya/photos', 'holiday.png')])
+        self.assertEqual(names(self.call(token, 'Search.files', query='no', prefix=True)), [('vasya', 'notes.png')])
+        self.assertEqual(names(self.call(token, 'Search.files', query='y_', path='vasya')), [('vasya', 'Holiday_2.png')])
+        self.assertEqual(names(self.call(token, 'Search.files', query='photos/h', in_path=True)),
+                         [('vasya/photos', 'holiday.png')])
+        self.assertEqual(self.call(token, 'Search.files', min_size=os.path.getsize(file_dir) + 1)['files'], [])
+        page = self.call(token, 'Search.files', query='.png', limit=2)
+        self.assertEqual(len(page['files']), 2)
+        rest = self.call(token, 'Search.files', query='.png', limit=2, cursor=page['next_cursor'])
+        self.assertEqual(names(rest), [('vasya', 'notes.png')])
+        self.assertIsNone(rest['next_cursor'])
+        self.call(token, 'Move.folder', path='vasya/photos', newpath='vasya', name='pictures')
+        self.assertEqual(names(self.call(token, 'Search.files', query='pictures', in_path=True)),
+                         [('vasya/pictures', 'holiday.png')])
+        # the ILIKE candidates of PostgreSQL, name and path matched each on its own
+        with mock.patch.object(search, 'enabled', lambda: False):
+            candidates = {file_id for file_id, in db.session.execute(search.matching('ictur', in_path=True))}
+            self.assertEqual(candidates, {File.query.filter_by(public_name='holiday.png').one().id})
+            self.assertEqual({file_id for file_id, in db.session.execute(search.matching('ictur'))}, set())
+        self.call(token, 'Delete.file', path='vasya', filename='notes.png')
+        self.assertEqual(self.call(token, 'Search.files', query='notes')['files'], [])
+
+    def test_move_files(self):
+        token = self.get_token()
+        self.make_folder(token)
+        self.upload(token=token, filename='a.png')
+        self.upload(token=token, filename='b.png')
+        response = self.call(token, 'Move.files', items=[
+            {"oldpath": "vasya", "newpath": "vasya/folder1", "filename": "a.png"},
+            {"oldpath": "vasya", "newpath": "vasya/folder1", "filename": "b.png"},
+            {"oldpath": "vasya", "newpath": "vasya/folder1", "filename": "a.png"},
+            {"oldpath": "vasya", "newpath": "vasya/ghost", "filename": "b.png"}])
+        self.assertEqual(response['results'], [{"message": "file has been moved"},
+                                               {"message": "file has been moved"},
+                                               {"message": "file is not available"},
+                                               {"message": "destination folder is not available"}])
+        self.assertEqual(self.call(token, 'View.user', path='vasya/folder1')['files_in'], ['a.png', 'b.png'])
+
+    def test_copy_file(self):
+        token = self.get_token()
+        self.make_folder(token)
+        self.upload(token=token, filename='default.png')
+        response = self.call(token, 'Copy.file', oldpath='vasya', newpath='vasya/folder1', filename='default.png')
+        self.assertEqual(response, {"file": "default.png", "message": "file has been copied"})
+        file = File.query.filter_by(public_name='default.png').first()
+        self.assertEqual(Blob.query.get(file.blob_hash).refcount, 2)
+        self.assertEqual(self.call(token, 'View.usage')['used'], 2 * os.path.getsize(file_dir))
+        self.call(token, 'Delete.file', path='vasya', filename='default.png')
+        downloaded = self.call(token, 'Get.file', path='vasya/folder1', filename='default.png')
+        with open(file_dir, 'rb') as image_file:
+            self.assertEqual(base64.b64decode(downloaded['file']), image_file.read())
+
+    def test_move_folder(self):
+        token = self.get_token()
+        self.make_folder(token, 'docs')
+        self.make_folder(token, 'archive')
+        self.call(token, 'Create.folder', path='vasya/docs', name='inner')
+        self.upload(token=token, filename='default.png')
+        self.call(token, 'Move.file', oldpath='vasya', newpath='vasya/docs/inner', filename='default.png')
+        response = self.call(token, 'Move.folder', path='vasya/docs', newpath='vasya/archive', name='old')
+        self.assertEqual(response, {"path": "vasya/archive/old", "message": "folder has been moved"})
+        self.assertEqual(self.call(token, 'View.tree', path='vasya')['files'], ['vasya/archive/old/inner/default.png'])
+        self.assertEqual(self.call(token, 'View.user', path='vasya/archive')['folders_in'], ['old'])
+        self.assertEqual(self.call(token, 'View.usage', path='vasya/archive')['used'], os.path.getsize(file_dir))
+        self.assertEqual(self.call(token, 'Move.folder', path='vasya/archive', newpath='vasya/archive/old'),
+                         {"message": "folder can not be moved into itself"})
+
+    def test_delete_folder(self):
+        token = self.get_token()
+        self.make_folder(token)
+        self.upload(token=token, filename='default.png')
+        self.call(token, 'Copy.file', oldpath='vasya', newpath='vasya/folder1', filename='default.png')
+        self.call(token, 'Share.file', path='vasya/folder1', filename='default.png', time='5')
+        response = self.call(token, 'Delete.folder', path='vasya/folder1')
+        self.assertEqual(response, {"path": "vasya/folder1", "message": "folder has been deleted"})
+        self.assertEqual(self.call(token, 'View.user', path='vasya')['folders_in'], 'folders is not created')
+        self.assertEqual(self.call(token, 'View.usage')['used'], os.path.getsize(file_dir))
+        self.assertEqual(PublicLinks.query.count(), 0)
+        self.assertEqual(Folder.reap_deleted(), 1)
+        self.assertEqual(File.query.count(), 1)
+        self.assertEqual(Blob.query.one().refcount, 1)
+        self.assertEqual(self.call(token, 'Delete.folder', path='vasya'), {"message": "folder is not available"})
+
+    def test_two_reapers_at_once(self):
+        token = self.get_token()
+        self.make_folder(token)
+        self.upload(token=token, filename='a.png')
+        self.call(token, 'Copy.file', oldpath='vasya', newpath='vasya/folder1', filename='a.png')
+        self.call(token, 'Delete.folder', path='vasya/folder1')
+        with self.deleted_meanwhile('all'):
+            self.assertEqual(Folder.reap_deleted(), 0)
+        # the other reaper releases the copy, a.png keeps its share
+        self.assertEqual(Blob.query.one().refcount, 2)
+        self.assertEqual(Folder.query.count(), 1)
+
+    def test_delete_and_share_files(self):
+        token = self.get_token()
+        self.upload(token=token, filename='a.png')
+        self.upload(token=token, filename='b.png')
+        shared = self.call(token, 'Share.files', items=[{"path": "vasya", "filename": "a.png", "time": "5"},
+                                                        {"path": "vasya", "filename": "c.png", "time": "5"}])
+        self.assertTrue(shared['results'][0].get('public_link'))
+        self.assertEqual(shared['results'][1], {"message": "file is not found"})
+        response = self.call(token, 'Delete.files', items=[{"path": "vasya", "filename": "a.png"},
+                                                           {"path": "vasya", "filename": "b.png"},
+                                                           {"path": "ne_vasya", "filename": "b.png"}])
+        self.assertEqual(response['results'], [{"file": "a.png", "message": "has been deleted"},
+                                               {"file": "b.png", "message": "has been deleted"},
+                                               {"message": "folder has not found"}])
+        self.assertEqual(Blob.query.count(), 0)
+
+    def test_wrong_items_in_a_batch(self):
+        token = self.get_token()
+        self.make_folder(token)
+        self.upload(token=token, filename='a.png')
+        shared = self.call(token, 'Share.files', items=[{"path": "vasya", "filename": "a.png", "time": "soon"},
+                                                        {"path": "vasya", "filename": "a.png", "time": "5"}])
+        self.assertEqual(shared['results'][0], {"message": "wrong item"})
+        self.assertTrue(shared['results'][1].get('public_link'))
+        move = {"oldpath": "vasya", "newpath": "vasya/folder1", "filename": "a.png"}
+        moved = self.call(token, 'Move.files', items=[dict(move, oldpath=["vasya"]), "a.png", move])
+        self.assertEqual(moved['results'], [{"message": "wrong item"}, {"message": "wrong item"},
+                                            {"message": "file has been moved"}])
+        deleted = self.call(token, 'Delete.files', items=[{"path": "vasya/folder1"},
+                                                          {"path": "vasya/folder1", "filename": "a.png"}])
+        self.assertEqual(deleted['results'], [{"message": "wrong item"},
+                                              {"file": "a.png", "message": "has been deleted"}])
+        self.assertEqual(self.call(token, 'Share.file', path='vasya', filename='a.png', time='soon'),
+                         {"message": "wrong time"})
+
+    def test_delete_files_twice_at_once(self):
+        token = self.get_token()
+        for filename in ['a.png', 'b.png', 'c.png']:
+            self.upload(token=token, filename=filename)
+        with self.deleted_meanwhile('__iter__'):
+            response = self.call(token, 'Delete.files', items=[{"path": "vasya", "filename": "a.png"},
+                                                               {"path": "vasya", "filename": "b.png"}])
+        self.assertEqual(response['results'], [{"message": "file has not found"}] * 2)
+        self.assertEqual(Blob.query.one().refcount, 3)
+        self.assertEqual(self.call(token, 'View.usage')['used'], 3 * os.path.getsize(file_dir))
+
     def test_download_file(self):
         token = self.get_token()
         filename = 'default.png'
@@ -229,6 +758,132 @@ class Tests(unittest.TestCase):
                                  headers={'content-type': 'application/json', 'x-access-token': token})
         self.assertTrue(json.loads(response.data)['result'].get('file'))
 
+    def test_stream_file(self):
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        with open(file_dir, 'rb') as image_file:
+            content = image_file.read()
+        response = self.app.get('/download/vasya/default.png', headers={'x-access-token': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content)
+        partial = self.app.get('/download/vasya/default.png',
+                               headers={'x-access-token': token, 'Range': 'bytes=100-199'})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.data, content[100:200])
+        cached = self.app.get('/download/vasya/default.png',
+                              headers={'x-access-token': token, 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(self.app.head('/download/vasya/default.png', headers={'x-access-token': token}).status_code, 200)
+        downloaded = self.call(token, 'Get.file', path='vasya', filename='default.png')
+        self.assertEqual(downloaded['download_count'], 2)
+
+    def test_download_counts_are_batched(self):
+        token = self.get_token()
+        for filename in ['a.png', 'b.png']:
+            self.upload(token=token, filename=filename)
+        for _ in range(3):
+            self.app.get('/download/vasya/a.png', headers={'x-access-token': token})
+        self.app.get('/download/vasya/b.png', headers={'x-access-token': token})
+        self.assertEqual({file.public_name: file.download_count for file in File.query}, {'a.png': 0, 'b.png': 0})
+        self.assertEqual(counters.downloads.flush(), 4)
+        db.session.expire_all()
+        self.assertEqual({file.public_name: file.download_count for file in File.query}, {'a.png': 3, 'b.png': 1})
+        self.assertEqual(counters.downloads.flush(), 0)
+        counts = [self.call(token, 'Get.file', path='vasya', filename='a.png')['download_count'] for _ in range(3)]
+        self.assertEqual(counts, [4, 5, 6])
+
+    def test_first_download_starts_the_flusher(self):
+        token = self.get_token()
+        self.upload(token=token, filename='a.png')
+        with mock.patch.object(counters.downloads, 'started', False), mock.patch.object(tasks, 'start') as start:
+            self.app.get('/download/vasya/a.png', headers={'x-access-token': token})
+            self.app.get('/download/vasya/a.png', headers={'x-access-token': token})
+        start.assert_called_once_with('download-counter')
+
+    def test_stream_without_token(self):
+        for url in ['/download/vasya/default.png', '/thumbnail/vasya/default.png']:
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(json.loads(response.data), {'message': 'Token is missing!'})
+            self.assertEqual(self.app.get(url, headers={'x-access-token': 'forged'}).status_code, 401)
+
+    def test_stream_ghost_file(self):
+        token = self.get_token()
+        response = self.app.get('/download/vasya/default.png', headers={'x-access-token': token})
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_file_from_memory_storage(self):
+        storage.set_backend(storage.MemoryStorage())
+        self.addCleanup(storage.set_backend, None)
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        with open(file_dir, 'rb') as image_file:
+            content = image_file.read()
+        response = self.app.get('/download/vasya/default.png', headers={'x-access-token': token})
+        self.assertEqual(response.data, content)
+        partial = self.app.get('/download/vasya/default.png',
+                               headers={'x-access-token': token, 'Range': 'bytes=-100'})
+        self.assertEqual(partial.data, content[-100:])
+
+    def asgi_request(self, method, path, body=b'', headers=()):
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+                 'headers': [(name.encode(), value.encode()) for name, value in headers]}
+        chunks = [{'type': 'http.request', 'body': body[i:i + 1000], 'more_body': i + 1000 < len(body)}
+                  for i in range(0, max(len(body), 1), 1000)]
+        sent = []
+
+        async def receive():
+            return chunks.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi.application(scope, receive, send))
+        return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_asgi_adapter(self):
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        data = json.dumps({"jsonrpc": "2.0", "method": "View.user", "params": {"path": "vasya"}, "id": "1"})
+        status, body = self.asgi_request('POST', '/api', data.encode(), headers=[
+            ('content-type', 'application/json'), ('x-access-token', token)])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['result']['files_in'], ['default.png'])
+        status, body = self.asgi_request('GET', '/download/vasya/default.png', headers=[('x-access-token', token)])
+        with open(file_dir, 'rb') as image_file:
+            self.assertEqual(body, image_file.read())
+
+    @unittest.skipUnless(importlib.util.find_spec('PIL'), 'Pillow is not installed')
+    def test_thumbnail(self):
+        from PIL import Image
+        thumbnails.set_cache(thumbnails.ThumbnailCache(tempfile.mkdtemp(), 1024*1024))
+        self.addCleanup(thumbnails.set_cache, None)
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        response = self.call(token, 'Get.thumbnail', path='vasya', filename='default.png', size=100)
+        self.assertEqual((response['size'], response['mimetype']), (128, 'image/png'))
+        image = Image.open(io.BytesIO(base64.b64decode(response['file'])))
+        self.assertEqual(max(image.size), 128)
+        digest = File.query.one().blob_hash
+        self.assertTrue(os.path.exists(thumbnails.get_cache().path(digest, 128)))
+        streamed = self.app.get('/thumbnail/vasya/default.png?size=100', headers={'x-access-token': token})
+        self.assertEqual(streamed.data, base64.b64decode(response['file']))
+        self.assertEqual(thumbnails.pregenerate(digest, 'identity', 'default.png'), None)
+        app.config['THUMBNAIL_PREGENERATE'] = (64,)
+        self.addCleanup(app.config.__setitem__, 'THUMBNAIL_PREGENERATE', ())
+        thumbnails.pregenerate(digest, 'identity', 'default.png').result()
+        self.assertTrue(os.path.exists(thumbnails.get_cache().path(digest, 64)))
+
+    def test_thumbnail_cache_drops_least_recently_used(self):
+        cache = thumbnails.ThumbnailCache(tempfile.mkdtemp(), 10)
+        cache.put('aa' * 32, 64, b'12345')
+        cache.put('bb' * 32, 64, b'12345')
+        cache.get('aa' * 32, 64)
+        cache.put('cc' * 32, 64, b'12345')
+        self.assertEqual(cache.get('aa' * 32, 64), b'12345')
+        self.assertIsNone(cache.get('bb' * 32, 64))
+        self.assertFalse(os.path.exists(cache.path('bb' * 32, 64)))
+
     def test_download_ghost_file(self):
         token = self.get_token()
         filename = 'default.png'
@@ -265,6 +920,27 @@ class Tests(unittest.TestCase):
                                  headers={'content-type': 'application/json', 'x-access-token': token})
         self.assertTrue(json.loads(response.data)['result'].get('public_link'))
 
+    def test_public_link(self):
+        token = self.get_token()
+        self.upload(token=token, filename='default.png')
+        link = self.call(token, 'Share.file', path='vasya', filename='default.png', time='5')['public_link']
+        renewed = self.call(token, 'Share.file', path='vasya', filename='default.png', time='5')['public_link']
+        self.assertEqual(self.app.get(f'/public/{link}').status_code, 404)
+        response = self.app.get(f'/public/{renewed}')
+        with open(file_dir, 'rb') as image_file:
+            self.assertEqual(response.data, image_file.read())
+
+    def test_sweep_expired_links(self):
+        token = self.get_token()
+        for filename in ['a.png', 'b.png', 'c.png']:
+            self.upload(token=token, filename=filename)
+        self.call(token, 'Share.file', path='vasya', filename='a.png', time='5')
+        expired = [self.call(token, 'Share.file', path='vasya', filename=filename, time='-1')['public_link']
+                   for filename in ['b.png', 'c.png']]
+        self.assertEqual(self.app.get(f'/public/{expired[0]}').status_code, 404)
+        self.assertEqual(PublicLinks.sweep_expired(batch_size=1), 2)
+        self.assertEqual(PublicLinks.query.count(), 1)
+
     def test_share_ghost_file(self):
         token = self.get_token()
         filename = 'default.png'
@@ -277,5 +953,65 @@ class Tests(unittest.TestCase):
                                  headers={'content-type': 'application/json', 'x-access-token': token})
         self.assertEqual(json.loads(response.data)['result'], {"message": "file is not found"})
 
+
+    def test_migrate_legacy_database(self):
+        workdir = tempfile.mkdtemp()
+        legacy_db = os.path.join(workdir, 'legacy.db')
+        with open(os.path.join(basedir, 'app.db'), 'rb') as source, open(legacy_db, 'wb') as target:
+            target.write(source.read())
+        upload_folder = app.config['UPLOAD_FOLDER']
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + legacy_db
+        app.config['UPLOAD_FOLDER'] = workdir
+        storage.set_backend(None)
+        self.addCleanup(storage.set_backend, None)
+        self.addCleanup(app.config.__setitem__, 'UPLOAD_FOLDER', upload_folder)
+        with open(os.path.join(workdir, '1_2_notes.txt'), 'wb') as file:
+            file.write(b'legacy content')
+        for statement in ["INSERT INTO user VALUES (1, 'vasya', 'sha256$x$y', 0)",
+                          "INSERT INTO folder VALUES (1, 'vasya', NULL, 'vasya', 1)",
+                          "INSERT INTO folder VALUES (2, 'docs', '1', 'vasya/docs', 1)",
+                          "INSERT INTO file VALUES (1, NULL, 'notes.txt', '1_2_notes.txt', 1, 2, 'vasya/docs/1_2_notes.txt', 0)"]:
+            db.engine.execute(statement)
+        self.assertEqual(migrations.upgrade(), 4)
+        self.assertEqual(migrations.upgrade(), 4)
+        file = File.query.get(1)
+        self.assertEqual(file.size, 14)
+        self.assertEqual(Blob.query.get(file.blob_hash).refcount, 1)
+        self.assertEqual(storage.read_blob(file.blob_hash), b'legacy content')
+        self.assertEqual(User.query.get(1).used_bytes, 14)
+        self.assertEqual([folder.used_bytes for folder in Folder.query.order_by(Folder.id)], [14, 14])
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        db.session.remove()
+
+
+class StorageTests(unittest.TestCase):
+
+    def check_backend(self, backend):
+        path = os.path.join(tempfile.mkdtemp(), 'blob.part')
+        with open(path, 'wb') as file:
+            file.write(b'content')
+        backend.put('ab/cd/abcd', path)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(backend.exists('ab/cd/abcd'))
+        self.assertEqual(backend.size('ab/cd/abcd'), 7)
+        with backend.open('ab/cd/abcd') as file:
+            self.assertEqual(file.read(), b'content')
+        backend.delete('ab/cd/abcd')
+        self.assertFalse(backend.exists('ab/cd/abcd'))
+
+    def test_local_storage(self):
+        self.check_backend(storage.LocalStorage(tempfile.mkdtemp()))
+
+    def test_memory_storage(self):
+        self.check_backend(storage.MemoryStorage())
+
+    @unittest.skipUnless(importlib.util.find_spec('moto'), 'moto is not installed')
+    def test_s3_storage(self):
+        import boto3
+        from moto import mock_aws
+        with mock_aws():
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='filebox')
+            self.check_backend(storage.S3Storage('filebox', region_name='us-east-1', multipart_threshold=5))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file